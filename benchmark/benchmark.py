@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from getopt import getopt
+from glob import glob
+from os.path import dirname
+from os.path import join
+from os.path import realpath
+from tempfile import TemporaryDirectory
+from tempfile import TemporaryFile
+
+RESULTS_VERSION = 1
+
+root_dir = join(dirname(realpath(__file__)), '..')
+generate_script = join(dirname(realpath(__file__)), 'generate.py')
+convert_script = join(root_dir, 'convert', 'convert.py')
+comparison_matrix_script = join(root_dir, 'comparison-matrix', 'comparison-matrix.py')
+proband_linkage_script = join(root_dir, 'proband-linkage', 'proband-linkage.py')
+find_segments_script = join(root_dir, 'proband-linkage', 'find-segments.py')
+
+sizes = [5, 10, 20, 40]
+markers = 100000
+jobs = 1
+seed = 1
+permutations = 100
+work_dir = None
+results_filename = 'results.json'
+compare_filename = None
+
+optlist, args = getopt(
+    sys.argv[1:], 'j:',
+    ['sizes=', 'markers=', 'jobs=', 'seed=', 'permutations=', 'work=', 'results=', 'compare=', 'help']
+)
+for name, value in optlist:
+    if name == '--sizes':
+        sizes = [int(size) for size in value.split(',')]
+    elif name == '--markers':
+        markers = int(value)
+    elif name in ('-j', '--jobs'):
+        jobs = int(value)
+    elif name == '--seed':
+        seed = int(value)
+    elif name == '--permutations':
+        permutations = int(value)
+    elif name == '--work':
+        work_dir = value
+    elif name == '--results':
+        results_filename = value
+    elif name == '--compare':
+        compare_filename = value
+    elif name == '--help':
+        print('Syntax: ./benchmark.py [--sizes=<n>,<n>...] [--markers=<n>] [-j <n> | --jobs=<n>]')
+        print('                       [--seed=<n>] [--permutations=<n>] [--work=<dir>]')
+        print('                       [--results=<file>] [--compare=<file>]')
+        print('sizes defaults to 5,10,20,40 families, markers defaults to 100000, jobs')
+        print('defaults to 1, seed defaults to 1, permutations defaults to 100, and results')
+        print('defaults to ./results.json. The cohorts are generated in a temporary directory')
+        print('unless a work directory is given.')
+        exit()
+
+def run(arguments, cwd, stdout=subprocess.DEVNULL):
+    '''
+    Run a command and return its wall time, CPU time and peak resident set size
+    in bytes, and the time at which each line that it printed ending in '...'
+    was printed, if its standard output is captured.
+    '''
+    banners = []
+    with TemporaryFile() as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            arguments, cwd=cwd, stdout=stdout, stderr=errors, env=dict(os.environ, PYTHONUNBUFFERED='1')
+        )
+        if stdout == subprocess.PIPE:
+            for line in process.stdout:
+                line = line.decode().strip()
+                if line.endswith('...'):
+                    banners.append((line[:-len('...')], time.perf_counter() - start))
+        #wait4 gives the resource usage of this child alone
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            errors.seek(0)
+            sys.stderr.write(errors.read().decode())
+            raise subprocess.CalledProcessError(process.returncode, arguments)
+    #ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return wall, usage.ru_utime + usage.ru_stime, peak_rss, banners
+
+def stages_of(banners, wall):
+    #each stage lasts from its banner to the next banner, or to the end of the run
+    stages = {}
+    for (stage, start), (next_stage, end) in zip(banners, banners[1:] + [(None, wall)]):
+        stages[stage] = stages.get(stage, 0) + end - start
+    return stages
+
+def raw_data_files(cohort_dir):
+    return sorted(
+        glob(cohort_dir + '/cases/*') + glob(cohort_dir + '/controls/*') + glob(cohort_dir + '/unknowns/*')
+    )
+
+def size_of(filenames):
+    return sum(os.path.getsize(filename) for filename in filenames)
+
+def record(tool, variant, cohort, input_bytes, items, item_name, measurement):
+    wall, cpu, peak_rss, banners = measurement
+    result = {
+        'tool': tool,
+        'variant': variant,
+        'families': cohort['families'],
+        'people': cohort['people'],
+        'markers': cohort['markers'],
+        'wall': wall,
+        'cpu': cpu,
+        'peak_rss': peak_rss,
+        'input_bytes': input_bytes,
+        'megabytes_per_second': input_bytes / 1e6 / wall,
+        item_name: items,
+        item_name + '_per_second': items / wall,
+    }
+    if banners:
+        result['stages'] = stages_of(banners, wall)
+    print(tool + ' ' + variant + ': ' + str(round(wall, 3)) + ' s, ' + str(round(peak_rss / 1e6, 1)) + ' MB')
+    return result
+
+def benchmark_startup():
+    #how long each program takes to import its modules and exit, which is all that --help does
+    results = []
+    for tool, script in (
+        ('convert', convert_script),
+        ('comparison-matrix', comparison_matrix_script),
+        ('proband-linkage', proband_linkage_script),
+    ):
+        wall, cpu, peak_rss, banners = run([sys.executable, script, '--help'], root_dir)
+        results.append({
+            'tool': tool, 'variant': 'startup', 'families': None, 'wall': wall, 'cpu': cpu, 'peak_rss': peak_rss,
+        })
+        print(tool + ' startup: ' + str(round(wall, 3)) + ' s, ' + str(round(peak_rss / 1e6, 1)) + ' MB')
+    return results
+
+def benchmark_convert(cohort_dir, cohort):
+    '''
+    Time convert.py in each of its modes. The stages of each run are timed by
+    when convert.py announces them. The HapMap cache is deleted before each run
+    except the second run with a raw data cache, so that only that run starts
+    warm.
+    '''
+    results = []
+    out_dir = cohort_dir + '/out'
+    cache_dir = cohort_dir + '/cache'
+    filenames = raw_data_files(cohort_dir)
+    input_bytes = size_of(filenames)
+    genotypes = cohort['people'] * cohort['markers']
+    variants = [
+        ('ped', []),
+        ('bed', ['--format=bed']),
+        ('thinned', ['--spacing=0.1']),
+        ('stream-by-chromosome', ['--stream-by-chromosome']),
+        ('cache-cold', ['--cache=' + cache_dir]),
+        ('cache-warm', ['--cache=' + cache_dir]),
+    ]
+    for variant, options in variants:
+        if variant != 'cache-warm':
+            shutil.rmtree(cohort_dir + '/hapmap.cache', ignore_errors=True)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir)
+        measurement = run(
+            [sys.executable, convert_script, '--out=' + out_dir, '--jobs=' + str(jobs)] + options,
+            cohort_dir, subprocess.PIPE
+        )
+        results.append(record('convert', variant, cohort, input_bytes, genotypes, 'genotypes', measurement))
+    shutil.rmtree(out_dir)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+def benchmark_comparison_matrix(cohort_dir, cohort):
+    results = []
+    filenames = raw_data_files(cohort_dir)
+    input_bytes = size_of(filenames)
+    genotypes = cohort['people'] * cohort['markers']
+    variants = [
+        ('table', []),
+        ('stream', ['--stream']),
+        ('index', ['--index=' + cohort_dir + '/markers.idx']),
+    ]
+    for variant, options in variants:
+        measurement = run([sys.executable, comparison_matrix_script] + options + filenames, cohort_dir)
+        results.append(record('comparison-matrix', variant, cohort, input_bytes, genotypes, 'genotypes', measurement))
+    os.remove(cohort_dir + '/markers.idx')
+    return results
+
+def benchmark_proband_linkage(cohort_dir, cohort):
+    results = []
+    filenames = glob(cohort_dir + '/linkage/cases/*') + glob(cohort_dir + '/linkage/controls/*')
+    input_bytes = size_of(filenames)
+    common_options = [
+        '--cases=linkage/cases', '--controls=linkage/controls', '--proband=case', '--alpha=1', '--no-bonferroni',
+        '--jobs=' + str(jobs),
+    ]
+    variants = [
+        ('all-segments', []),
+        ('permutations', ['--permutations=' + str(permutations), '--seed=' + str(seed)]),
+    ]
+    for variant, options in variants:
+        measurement = run([sys.executable, proband_linkage_script] + common_options + options, cohort_dir)
+        results.append(record('proband-linkage', variant, cohort, input_bytes, cohort['segments'], 'segments', measurement))
+    return results
+
+def benchmark_find_segments(cohort_dir, cohort):
+    #compare the first case with everyone else in the cases and controls
+    out_dir = cohort_dir + '/segments'
+    filenames = sorted(glob(cohort_dir + '/cases/*')) + sorted(glob(cohort_dir + '/controls/*'))
+    input_bytes = size_of(filenames)
+    measurement = run([
+        sys.executable, find_segments_script, '--proband=' + filenames[0], '--out=' + out_dir, '--min-snps=100',
+        '--jobs=' + str(jobs),
+    ], cohort_dir, subprocess.PIPE)
+    shutil.rmtree(out_dir)
+    return [record('find-segments', 'scan', cohort, input_bytes, len(filenames) - 1, 'pairs', measurement)]
+
+def commit_of():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old_results, new_results):
+    #the wall time and peak RSS of each run in both files, and the ratio of new to old
+    old_runs = {(run['tool'], run['variant'], run['families']): run for run in old_results['runs']}
+    print('Tool\tVariant\tFamilies\tOld wall\tNew wall\tRatio\tOld peak RSS\tNew peak RSS\tRatio')
+    for new_run in new_results['runs']:
+        key = (new_run['tool'], new_run['variant'], new_run['families'])
+        if key not in old_runs:
+            continue
+        old_run = old_runs[key]
+        print('\t'.join(map(str, key + (
+            round(old_run['wall'], 3), round(new_run['wall'], 3), round(new_run['wall'] / old_run['wall'], 2),
+            old_run['peak_rss'], new_run['peak_rss'], round(new_run['peak_rss'] / old_run['peak_rss'], 2),
+        ))))
+
+def benchmark(work_dir):
+    runs = benchmark_startup()
+    for families in sizes:
+        cohort_dir = work_dir + '/families' + str(families) + '-markers' + str(markers) + '-seed' + str(seed)
+        if not os.path.exists(cohort_dir + '/cohort.json'):
+            print('Generating ' + str(families) + ' families...')
+            subprocess.run([
+                sys.executable, generate_script, '--out=' + cohort_dir, '--families=' + str(families),
+                '--markers=' + str(markers), '--seed=' + str(seed),
+            ], check=True)
+        with open(cohort_dir + '/cohort.json') as cohort_file:
+            cohort = json.load(cohort_file)
+        runs += benchmark_convert(cohort_dir, cohort)
+        runs += benchmark_comparison_matrix(cohort_dir, cohort)
+        runs += benchmark_proband_linkage(cohort_dir, cohort)
+        runs += benchmark_find_segments(cohort_dir, cohort)
+    return runs
+
+results = {
+    'version': RESULTS_VERSION,
+    'commit': commit_of(),
+    'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'jobs': jobs,
+    'seed': seed,
+}
+if work_dir:
+    os.makedirs(work_dir, exist_ok=True)
+    #the programs run in the cohort directories, so the paths given to them must not be relative
+    results['runs'] = benchmark(realpath(work_dir))
+else:
+    with TemporaryDirectory() as temp_dir:
+        results['runs'] = benchmark(temp_dir)
+
+with open(results_filename, 'w') as results_file:
+    json.dump(results, results_file, indent=4)
+    results_file.write('\n')
+
+if compare_filename:
+    with open(compare_filename) as compare_file:
+        compare(json.load(compare_file), results)
@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+
+import filecmp
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+from copy import copy
+from getopt import getopt
+from os.path import dirname
+from os.path import join
+from os.path import realpath
+from tempfile import TemporaryDirectory
+
+root_dir = join(dirname(realpath(__file__)), '..')
+generate_script = join(dirname(realpath(__file__)), 'generate.py')
+convert_script = join(root_dir, 'convert', 'convert.py')
+comparison_matrix_script = join(root_dir, 'comparison-matrix', 'comparison-matrix.py')
+
+sys.path.insert(0, join(root_dir, 'convert'))
+sys.path.insert(0, join(root_dir, 'proband-linkage'))
+sys.path.insert(0, join(root_dir, 'comparison-matrix'))
+
+import numpy
+from comparison import compare_streamed
+from comparison import unpack
+from converter import AUTOSOMES
+from converter import Converter
+from converter import PARENT_OR_CHILD
+from converter import SIBLING
+from converter import classify_relationships
+from converter import list_files
+from hapmap import load_hap_map
+from linkage import CASE
+from linkage import CHROMOSOMES
+from linkage import Cohort
+from linkage import PValueCache
+from linkage import test_names
+from linkage import list_files as list_comparison_files
+from rawdata import parse_file
+from relatedness import match_totals
+
+families = 3
+markers = 10000
+seed = 1
+work_dir = None
+
+optlist, args = getopt(sys.argv[1:], '', ['families=', 'markers=', 'seed=', 'work=', 'help'])
+for name, value in optlist:
+    if name == '--families':
+        families = int(value)
+    elif name == '--markers':
+        markers = int(value)
+    elif name == '--seed':
+        seed = int(value)
+    elif name == '--work':
+        work_dir = value
+    elif name == '--help':
+        print('Syntax: ./check.py [--families=<n>] [--markers=<n>] [--seed=<n>] [--work=<dir>]')
+        print('families defaults to 3, markers defaults to 10000, and seed defaults to 1. The')
+        print('cohort is generated in a temporary directory unless a work directory is given.')
+        exit()
+
+def raw_data_files(cohort_dir):
+    return list_files([(cohort_dir + '/cases', '2'), (cohort_dir + '/controls', '1'), (cohort_dir + '/unknowns', '0')])
+
+def old_match(bases1, bases2):
+    #whether two genotypes share a base and whether they share both, compared as convert.py did
+    if bases1[0] == bases2[0]:
+        return True, bases1[1] == bases2[1]
+    elif bases1[0] == bases2[1]:
+        return True, bases1[1] == bases2[0]
+    elif bases1[1] == bases2[0]:
+        return True, bases1[0] == bases2[1]
+    elif bases1[1] == bases2[1]:
+        return True, bases1[0] == bases2[0]
+    return False, False
+
+def old_relationships(files, snp_map, hap_map):
+    '''
+    The match totals and relationships of every pair of people, compared one
+    pair and one marker at a time in each person's file order, as convert.py
+    did before the match engine in relatedness.py.
+    '''
+    raw_data = {}
+    for filename, person_id, affection in files:
+        rsids, chromosomes, bp_positions, genotypes, codes = parse_file(filename)
+        raw_data[person_id] = {}
+        for rsid, chromosome, code in zip(rsids.tolist(), chromosomes.tolist(), codes.tolist()):
+            raw_data[person_id].setdefault(chromosome.decode(), {})[rsid.decode()] = genotypes[code]
+
+    totals = {}
+    relationship_table = {person_id: {} for person_id in raw_data}
+    for person1_id in raw_data:
+        for person2_id in raw_data:
+            if person1_id == person2_id or person1_id in relationship_table[person2_id]:
+                continue
+
+            half_matches = 0
+            full_matches = 0
+            possible_matches = 0
+
+            for chromosome in AUTOSOMES:
+                if chromosome in hap_map:
+                    last_cm_pos = 0
+                    sorted_snps = sorted(raw_data[person1_id][chromosome], key=lambda rsid: snp_map[rsid][2])
+                    for rsid in sorted_snps:
+                        if rsid not in raw_data[person2_id][chromosome]:
+                            continue
+                        dist_to_last = snp_map[rsid][2] - last_cm_pos
+                        half_match, full_match = old_match(
+                            raw_data[person1_id][chromosome][rsid], raw_data[person2_id][chromosome][rsid]
+                        )
+                        half_matches += dist_to_last * half_match
+                        full_matches += dist_to_last * full_match
+                        last_cm_pos = snp_map[rsid][2]
+                    possible_matches += last_cm_pos
+                else:
+                    snps = raw_data[person1_id][chromosome]
+                    for rsid in snps:
+                        half_match, full_match = old_match(
+                            raw_data[person1_id][chromosome][rsid], raw_data[person2_id][chromosome][rsid]
+                        )
+                        half_matches += half_match
+                        full_matches += full_match
+                    possible_matches += len(snps)
+
+            totals[(person1_id, person2_id)] = (half_matches, full_matches, possible_matches)
+            if half_matches / possible_matches > 0.98:
+                relationship_table[person1_id][person2_id] = PARENT_OR_CHILD
+                relationship_table[person2_id][person1_id] = PARENT_OR_CHILD
+            elif full_matches / possible_matches > 0.70:
+                relationship_table[person1_id][person2_id] = SIBLING
+                relationship_table[person2_id][person1_id] = SIBLING
+    return totals, relationship_table
+
+def check_relatedness(cohort_dir):
+    #the match engine must find the same parents, children and siblings as the pair by pair loop
+    hap_map = load_hap_map(cohort_dir + '/hapmap')
+    files = raw_data_files(cohort_dir)
+    raw_data, snp_map = Converter(hap_map).parse(files)
+    person_ids, half_matches, full_matches, possible_matches = match_totals(raw_data, snp_map, hap_map, AUTOSOMES)
+    old_totals, old_relationship_table = old_relationships(files, snp_map, hap_map)
+
+    index = {person_id: i for i, person_id in enumerate(person_ids)}
+    for (person1_id, person2_id), old_pair_totals in old_totals.items():
+        i = index[person1_id]
+        j = index[person2_id]
+        new_pair_totals = (half_matches[i][j], full_matches[i][j], possible_matches[i][j])
+        if not numpy.allclose(new_pair_totals, old_pair_totals, rtol=1e-9, atol=1e-9):
+            return 'match totals of ' + person1_id + ' and ' + person2_id + ' differ'
+    if classify_relationships(person_ids, half_matches, full_matches, possible_matches) != old_relationship_table:
+        return 'relationships differ'
+    return None
+
+def check_stream_by_chromosome(cohort_dir):
+    #both modes must write the same bytes from a cohort that mixes the raw data formats
+    with open(cohort_dir + '/cohort.json') as cohort_file:
+        formats = json.load(cohort_file)['formats']
+    if 0 in formats.values():
+        return 'the cohort does not have files in every format, so try another seed'
+    for output_format in ('ped', 'bed'):
+        out_dirs = [cohort_dir + '/out', cohort_dir + '/out-by-chromosome']
+        for out_dir, options in zip(out_dirs, [[], ['--stream-by-chromosome']]):
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.makedirs(out_dir)
+            subprocess.run(
+                [sys.executable, convert_script, '--out=' + out_dir, '--format=' + output_format] + options,
+                cwd=cohort_dir, stdout=subprocess.DEVNULL, check=True
+            )
+        filenames = sorted(os.listdir(out_dirs[0]))
+        if sorted(os.listdir(out_dirs[1])) != filenames:
+            return 'the output files differ'
+        for filename in filenames:
+            if not filecmp.cmp(out_dirs[0] + '/' + filename, out_dirs[1] + '/' + filename, shallow=False):
+                return filename + ' differs'
+        for out_dir in out_dirs:
+            shutil.rmtree(out_dir)
+    return None
+
+def old_partition(files):
+    '''
+    The segments of each chromosome as [start, end, cases, controls] lists,
+    split by inserting into a list one comparison file row at a time as
+    proband-linkage.py did before add_breakpoints and build_segments. The
+    proband is a case.
+    '''
+    def create_start_point(segments, point):
+        for i in range(0, len(segments)):
+            if segments[i][0] < point and point < segments[i][1]:
+                segments.insert(i + 1, [point, segments[i][1], copy(segments[i][2]), copy(segments[i][3])])
+                segments[i][1] = point - 1
+                break
+
+    def create_end_point(segments, point):
+        for i in range(0, len(segments)):
+            if segments[i][0] < point and point < segments[i][1]:
+                segments.insert(i, [segments[i][0], point, copy(segments[i][2]), copy(segments[i][3])])
+                segments[i + 1][0] = point + 1
+                break
+
+    linkage = {chromosome: [[0, sys.maxsize, ['Proband'], []]] for chromosome in CHROMOSOMES}
+    for filename, is_case in files:
+        person_name = os.path.splitext(os.path.basename(filename))[0]
+        with open(filename, newline='') as csv_file:
+            for row in csv.reader(csv_file):
+                if row == ['Comparison', 'Chromosome', 'Start Point', 'End Point', 'Genetic Distance', '#SNPs']:
+                    continue
+                chromosome = row[1]
+                start_point = int(row[2])
+                end_point = int(row[3])
+                create_start_point(linkage[chromosome], start_point)
+                create_end_point(linkage[chromosome], end_point)
+                for segment in linkage[chromosome]:
+                    if start_point <= segment[0] and segment[1] <= end_point:
+                        if is_case:
+                            segment[2].append(person_name)
+                        else:
+                            segment[3].append(person_name)
+    return linkage
+
+def comparison_files(cohort_dir):
+    return (
+        [(filename, True) for filename in list_comparison_files(cohort_dir + '/linkage/cases')] +
+        [(filename, False) for filename in list_comparison_files(cohort_dir + '/linkage/controls')]
+    )
+
+def write_edge_file(filename, files):
+    '''
+    Write a comparison file of segments that start or end right next to the
+    segments of the first file in files, where whether a point splits a
+    segment depends on the points before it. Generated cohorts hardly ever
+    have such segments by chance.
+    '''
+    with open(files[0][0], newline='') as csv_file:
+        rows = [row for row in csv.reader(csv_file)][1:]
+    with open(filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['Comparison', 'Chromosome', 'Start Point', 'End Point', 'Genetic Distance', '#SNPs'])
+        for row in rows:
+            start_point = int(row[2])
+            end_point = int(row[3])
+            for edge_start, edge_end in ((start_point + 1, end_point - 1), (end_point, end_point + 1), (start_point - 1, start_point)):
+                writer.writerow([row[0], row[1], edge_start, edge_end, row[4], row[5]])
+
+def check_partition(cohort_dir):
+    #the sweep must give the same segment boundaries, shared by the same people, as the list splitting
+    files = comparison_files(cohort_dir)
+    os.makedirs(cohort_dir + '/edges', exist_ok=True)
+    write_edge_file(cohort_dir + '/edges/edges.csv', files)
+    files.append((cohort_dir + '/edges/edges.csv', False))
+    cohort = Cohort(CASE)
+    cohort.load_files(files)
+    linkage = cohort.partition()
+    old_linkage = old_partition(files)
+    for chromosome in CHROMOSOMES:
+        segments = [
+            (start, end, cohort.names_of(members & cohort.cases), cohort.names_of(members & cohort.controls))
+            for start, end, members in linkage[chromosome]
+        ]
+        old_segments = [(start, end, set(cases), set(controls)) for start, end, cases, controls in old_linkage[chromosome]]
+        if segments != old_segments:
+            return 'the segments of chromosome ' + chromosome + ' differ'
+    shutil.rmtree(cohort_dir + '/edges')
+    return None
+
+def old_p_value(table, method, yates):
+    #the p-value and test of one 2x2 contingency table, from one SciPy call as proband-linkage.py made them
+    from scipy.stats import chi2_contingency
+    from scipy.stats import fisher_exact
+    from scipy.stats import power_divergence
+    from scipy.stats.contingency import expected_freq
+
+    chi_name = 'Yates chi-squared' if yates else 'Chi-squared'
+    if method == 'chi':
+        return chi2_contingency(table, correction=yates)[1], chi_name
+    elif method == 'fisher':
+        return fisher_exact(table)[1], 'Fisher'
+    elif method == 'g':
+        p = power_divergence(
+            table[0] + table[1], f_exp=expected_freq(table).ravel(), ddof=2, lambda_='log-likelihood'
+        )[1]
+        return p, 'G-test'
+    expected_frequency_table = expected_freq(table)
+    num_large_cells = 0
+    num_small_cells = 0
+    for row in expected_frequency_table:
+        for cell in row:
+            if cell >= 5:
+                num_large_cells += 1
+            elif cell < 1:
+                num_small_cells += 1
+                break
+    if num_large_cells >= 3 and num_small_cells == 0:
+        return chi2_contingency(table, correction=yates)[1], chi_name
+    return fisher_exact(table)[1], 'Fisher'
+
+def check_p_values(cohort_dir):
+    '''
+    Every table that the cohort's segments could have, and every table of a
+    cohort of 25 cases and 35 controls, which is big enough for the auto method
+    to choose both tests, must get the same test and, within a relative
+    tolerance of 1e-9, the same p-value from the batched tests as from SciPy,
+    with each method. Tables that SciPy cannot test are left out.
+    '''
+    cohort = Cohort(CASE)
+    cohort.load_files(comparison_files(cohort_dir))
+    tables = numpy.array([
+        [[a, b], [num_cases - a, num_controls - b]]
+        for num_cases, num_controls in ((cohort.num_cases, cohort.num_controls), (25, 35))
+        for a in range(0, num_cases + 1) for b in range(0, num_controls + 1)
+    ], dtype=numpy.int64)
+    for method in ('chi', 'fisher', 'g', 'auto'):
+        for yates in (True, False):
+            p_values, tests = PValueCache(int(tables.sum(axis=(1, 2)).max())).test(tables, method, yates)
+            for table, p, test_name in zip(tables.tolist(), p_values.tolist(), test_names(tests, yates)):
+                try:
+                    with numpy.errstate(divide='ignore', invalid='ignore'):
+                        old_p, old_test_name = old_p_value(table, method, yates)
+                except ValueError:
+                    continue
+                if test_name != old_test_name or not numpy.isclose(p, old_p, rtol=1e-9, atol=0, equal_nan=True):
+                    return 'the p-value of ' + str(table) + ' with method ' + method + ' differs'
+    return None
+
+def old_comparison_matrix(filenames):
+    #the table of comparison-matrix.py from a set of rsids per file, as it was before the NumPy parser
+    rows_to_ignore = [
+        ['rsid', 'chromosome', 'position', 'allele1', 'allele2'], #Ancestry.com
+        ['Name', 'Variation', 'Chromosome', 'Position', 'Strand', 'YourCode'], #deCODEme
+        ['RSID', 'CHROMOSOME', 'POSITION', 'RESULT'], #FTDNA
+    ]
+    all_snps = set()
+    snps_by_file = []
+    for filename in filenames:
+        snps_in_file = set()
+        if filename.endswith('.csv'):
+            delimiter = ','
+        else:
+            delimiter = '\t'
+        with open(filename, newline='') as raw_file:
+            for row in csv.reader(raw_file, delimiter=delimiter):
+                if row[0].startswith('#'):
+                    continue
+                if row in rows_to_ignore:
+                    continue
+                all_snps.add(row[0])
+                snps_in_file.add(row[0])
+        snps_by_file.append(snps_in_file)
+
+    lines = ['\t' + '\t'.join(filenames) + '\n']
+    for rsid in sorted(all_snps):
+        lines.append(rsid + ''.join('\tYes' if rsid in snps_in_file else '\tNo' for snps_in_file in snps_by_file) + '\n')
+    return ''.join(lines)
+
+def write_subset_files(subset_dir, filenames):
+    #copies of files that each leave out a different share of the markers, since generated files all have the same ones
+    os.makedirs(subset_dir, exist_ok=True)
+    subset_filenames = []
+    for i, filename in enumerate(filenames):
+        subset_filename = subset_dir + '/' + os.path.basename(filename)
+        with open(filename) as raw_file, open(subset_filename, 'w') as subset_file:
+            for j, line in enumerate(raw_file):
+                if line.startswith('#') or j % (i + 2) != 1:
+                    subset_file.write(line)
+        subset_filenames.append(subset_filename)
+    return subset_filenames
+
+def check_comparison_matrix(cohort_dir):
+    '''
+    comparison-matrix.py must write the same table with and without --stream
+    as it did before, and so must the merge of compare_streamed with blocks
+    small enough that it has to merge many blocks of every file.
+    '''
+    filenames = [filename for filename, person_id, affection in raw_data_files(cohort_dir)]
+    filenames = filenames[:2] + write_subset_files(cohort_dir + '/subsets', filenames[:4])
+    old_table = old_comparison_matrix(filenames)
+    for options in ([], ['--stream']):
+        table = subprocess.run(
+            [sys.executable, comparison_matrix_script] + options + filenames, stdout=subprocess.PIPE, check=True
+        ).stdout.decode()
+        if table != old_table:
+            return 'the table of comparison-matrix.py ' + ' '.join(options) + ' differs'
+    with TemporaryDirectory() as temp_dir:
+        for block_size in (1000, 7):
+            lines = ['\t' + '\t'.join(filenames) + '\n']
+            for all_snps, bits in compare_streamed(filenames, temp_dir, block_size):
+                for rsid, present in zip(all_snps.tolist(), unpack(bits, len(filenames)).tolist()):
+                    lines.append(rsid.decode() + ''.join('\tYes' if bit else '\tNo' for bit in present) + '\n')
+            if ''.join(lines) != old_table:
+                return 'the merge of blocks of ' + str(block_size) + ' rsids differs'
+    shutil.rmtree(cohort_dir + '/subsets')
+    return None
+
+CHECKS = [
+    ('relatedness', check_relatedness),
+    ('stream-by-chromosome', check_stream_by_chromosome),
+    ('partition', check_partition),
+    ('p-values', check_p_values),
+    ('comparison-matrix', check_comparison_matrix),
+]
+
+def check(cohort_dir):
+    failures = 0
+    for name, check_function in CHECKS:
+        try:
+            error = check_function(cohort_dir)
+        except Exception as exception:
+            error = type(exception).__name__ + ': ' + str(exception)
+        if error:
+            print(name + ': FAILED: ' + error)
+            failures += 1
+        else:
+            print(name + ': OK')
+    return failures
+
+def generate(work_dir):
+    #a third of the files in each format, so that a small cohort almost always has all three
+    cohort_dir = work_dir + '/families' + str(families) + '-markers' + str(markers) + '-seed' + str(seed)
+    if not os.path.exists(cohort_dir + '/cohort.json'):
+        subprocess.run([
+            sys.executable, generate_script, '--out=' + cohort_dir, '--families=' + str(families),
+            '--markers=' + str(markers), '--seed=' + str(seed), '--ancestry=0.33', '--ftdna=0.33',
+        ], stdout=subprocess.DEVNULL, check=True)
+    return cohort_dir
+
+if work_dir:
+    os.makedirs(work_dir, exist_ok=True)
+    failures = check(generate(realpath(work_dir)))
+else:
+    with TemporaryDirectory() as temp_dir:
+        failures = check(generate(temp_dir))
+
+if failures:
+    exit(1)
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+import json
+import numpy
+import os
+import sys
+from getopt import getopt
+from operator import add
+
+#GRCh37 lengths in base pairs
+CHROMOSOME_LENGTHS = {
+    '1': 249250621, '2': 243199373, '3': 198022430, '4': 191154276, '5': 180915260, '6': 171115067,
+    '7': 159138663, '8': 146364022, '9': 141213431, '10': 135534747, '11': 135006516, '12': 133851895,
+    '13': 115169878, '14': 107349540, '15': 102531392, '16': 90354753, '17': 81195210, '18': 78077248,
+    '19': 59128983, '20': 63025520, '21': 48129895, '22': 51304566, 'X': 155270560, 'Y': 59373566,
+    'MT': 16569,
+}
+AUTOSOMES = list(map(str, range(1, 23)))
+MAPPED_CHROMOSOMES = AUTOSOMES + ['X']
+CHROMOSOMES = MAPPED_CHROMOSOMES + ['Y', 'MT']
+
+#the chromosome and base pair range that the cases share with the proband more often than the controls
+LINKED_CHROMOSOME = '6'
+LINKED_RANGE = (30000000, 34000000)
+
+FORMATS = ('23andme', 'ancestry', 'ftdna')
+
+out_dir = '.'
+families = 10
+markers = 100000
+relatives = None
+ancestry_fraction = 0.2
+ftdna_fraction = 0.1
+no_call_rate = 0.002
+seed = 1
+
+optlist, args = getopt(
+    sys.argv[1:], '',
+    ['out=', 'families=', 'markers=', 'relatives=', 'ancestry=', 'ftdna=', 'no-calls=', 'seed=', 'help']
+)
+for name, value in optlist:
+    if name == '--out':
+        out_dir = value
+    elif name == '--families':
+        families = int(value)
+    elif name == '--markers':
+        markers = int(value)
+    elif name == '--relatives':
+        relatives = int(value)
+    elif name == '--ancestry':
+        ancestry_fraction = float(value)
+    elif name == '--ftdna':
+        ftdna_fraction = float(value)
+    elif name == '--no-calls':
+        no_call_rate = float(value)
+    elif name == '--seed':
+        seed = int(value)
+    elif name == '--help':
+        print('Syntax: ./generate.py [--out=<dir>] [--families=<n>] [--markers=<n>] [--relatives=<n>]')
+        print('                      [--ancestry=<fraction>] [--ftdna=<fraction>] [--no-calls=<rate>]')
+        print('                      [--seed=<n>]')
+        print('out defaults to the current directory, families defaults to 10, markers')
+        print('defaults to 100000, relatives defaults to 4 per family, ancestry defaults to')
+        print('0.2, ftdna defaults to 0.1, no-calls defaults to 0.002, and seed defaults to 1.')
+        exit()
+
+if relatives is None:
+    relatives = 4 * families
+
+rng = numpy.random.default_rng(seed)
+
+def write_hap_maps():
+    '''
+    Write a HapMap-style genetic map of each chromosome except Y and MT, with
+    map points a few hundred kilobases apart and recombination rates that vary
+    around 1.2 cM/Mb, and return the maps as pairs of base pair and centimorgan
+    arrays.
+    '''
+    os.makedirs(out_dir + '/hapmap', exist_ok=True)
+    hap_map = {}
+    for chromosome in MAPPED_CHROMOSOMES:
+        length = CHROMOSOME_LENGTHS[chromosome]
+        gaps = rng.integers(1000, 400000, length // 200000)
+        bp_positions = numpy.cumsum(gaps)
+        bp_positions = bp_positions[bp_positions < length]
+        rates = rng.gamma(2, 0.6, len(bp_positions))
+        cm_positions = numpy.cumsum(numpy.diff(bp_positions, prepend=0) * rates / 1e6)
+        hap_map[chromosome] = (bp_positions, cm_positions)
+        with open(out_dir + '/hapmap/genetic_map_GRCh37_chr' + chromosome + '.txt', 'w') as map_file:
+            map_file.write('Chromosome\tPosition(bp)\tRate(cM/Mb)\tMap(cM)\n')
+            map_file.write(''.join(
+                'chr' + chromosome + '\t' + str(bp) + '\t' + str(round(rate, 6)) + '\t' + str(round(cm, 6)) + '\n'
+                for bp, rate, cm in zip(bp_positions.tolist(), rates.tolist(), cm_positions.tolist())
+            ))
+    return hap_map
+
+def centimorgans(hap_map, chromosome, bp_positions):
+    map_bp, map_cm = hap_map[chromosome]
+    return numpy.interp(bp_positions, numpy.concatenate(([0], map_bp)), numpy.concatenate(([0], map_cm)))
+
+def make_markers(hap_map):
+    '''
+    Return a dict of chromosome to its markers: sorted base pair positions,
+    centimorgan positions, rsids, the two alleles and the frequency of the
+    second allele. The markers are spread over the chromosomes in proportion to
+    their lengths, except that MT gets a fixed share.
+    '''
+    genome_length = sum(CHROMOSOME_LENGTHS[chromosome] for chromosome in CHROMOSOMES if chromosome != 'MT')
+    marker_table = {}
+    next_rsid = 1000
+    for chromosome in CHROMOSOMES:
+        length = CHROMOSOME_LENGTHS[chromosome]
+        if chromosome == 'MT':
+            count = max(markers // 500, 1)
+        else:
+            count = max(markers * length // genome_length, 1)
+        bp_positions = numpy.unique(rng.integers(1, length, count))
+        if chromosome in hap_map:
+            cm_positions = centimorgans(hap_map, chromosome, bp_positions)
+        else:
+            cm_positions = numpy.zeros(len(bp_positions))
+        rsids = next_rsid + numpy.cumsum(rng.integers(1, 50, len(bp_positions)))
+        next_rsid = int(rsids[-1])
+        #a few markers have 23andMe's internal ids instead of rsids
+        prefixes = numpy.where(rng.random(len(rsids)) < 0.05, 'i', 'rs')
+        #like a genotyping chip, a mix of rare variants and common ones
+        frequencies = numpy.where(rng.random(len(rsids)) < 0.3, rng.uniform(0.001, 0.02, len(rsids)), rng.uniform(0.4, 0.5, len(rsids)))
+        alleles = numpy.array([list(pair) for pair in ('AG', 'CT', 'AC', 'GT', 'AT', 'CG')])[rng.integers(0, 6, len(rsids))]
+        marker_table[chromosome] = {
+            'bp': bp_positions,
+            'cm': cm_positions,
+            'rsids': [prefix + str(rsid) for prefix, rsid in zip(prefixes.tolist(), rsids.tolist())],
+            'alleles': alleles,
+            'frequencies': frequencies,
+        }
+    return marker_table
+
+class Person:
+    def __init__(self, name, sex, haplotypes):
+        #haplotypes maps each chromosome to a (2, markers) array of allele indexes: maternal, then paternal
+        self.name = name
+        self.sex = sex
+        self.haplotypes = haplotypes
+
+def founder(name, sex, marker_table):
+    haplotypes = {}
+    for chromosome, chromosome_markers in marker_table.items():
+        haplotypes[chromosome] = (rng.random((2, len(chromosome_markers['bp']))) < chromosome_markers['frequencies']).astype(numpy.uint8)
+    if sex == 'M':
+        haplotypes['X'][1] = haplotypes['X'][0]
+    return Person(name, sex, haplotypes)
+
+def gamete(parent, chromosome, cm_positions):
+    #one haplotype made of the parent's two, switching between them at crossovers placed uniformly in centimorgans
+    haplotypes = parent.haplotypes[chromosome]
+    if len(cm_positions) == 0 or cm_positions[-1] == 0:
+        return haplotypes[rng.integers(0, 2)].copy()
+    crossovers = numpy.sort(rng.uniform(0, cm_positions[-1], rng.poisson(cm_positions[-1] / 100)))
+    which = (rng.integers(0, 2) + numpy.searchsorted(crossovers, cm_positions)) % 2
+    return numpy.where(which == 1, haplotypes[1], haplotypes[0])
+
+def child(name, sex, father, mother, marker_table):
+    haplotypes = {}
+    for chromosome, chromosome_markers in marker_table.items():
+        cm_positions = chromosome_markers['cm']
+        if chromosome == 'MT':
+            maternal = paternal = mother.haplotypes['MT'][0]
+        elif chromosome == 'Y':
+            maternal = paternal = father.haplotypes['Y'][1]
+        elif chromosome == 'X':
+            maternal = gamete(mother, 'X', cm_positions)
+            paternal = father.haplotypes['X'][0] if sex == 'F' else maternal
+        else:
+            maternal = gamete(mother, chromosome, cm_positions)
+            paternal = gamete(father, chromosome, cm_positions)
+        haplotypes[chromosome] = numpy.array([maternal, paternal])
+    return Person(name, sex, haplotypes)
+
+def make_families(marker_table):
+    '''
+    Make each family: two founders, two to four children, and in half of the
+    families a grandchild of the first child and a founder who married in.
+    '''
+    people = []
+    for family in range(families):
+        prefix = 'fam' + str(family + 1) + '-'
+        father = founder(prefix + 'father', 'M', marker_table)
+        mother = founder(prefix + 'mother', 'F', marker_table)
+        children = [
+            child(prefix + 'child' + str(i + 1), rng.choice(['M', 'F']), father, mother, marker_table)
+            for i in range(rng.integers(2, 5))
+        ]
+        people += [father, mother] + children
+        if family % 2 == 0:
+            spouse_sex = 'F' if children[0].sex == 'M' else 'M'
+            spouse = founder(prefix + 'spouse', spouse_sex, marker_table)
+            if children[0].sex == 'M':
+                grandchild = child(prefix + 'grandchild', rng.choice(['M', 'F']), children[0], spouse, marker_table)
+            else:
+                grandchild = child(prefix + 'grandchild', rng.choice(['M', 'F']), spouse, children[0], marker_table)
+            people += [spouse, grandchild]
+    return people
+
+def genotype_strings(person, chromosome, chromosome_markers):
+    #(allele 1, allele 2) of each marker, with a single allele on haploid chromosomes and '-' for no-calls
+    haplotypes = person.haplotypes[chromosome]
+    alleles = chromosome_markers['alleles']
+    rows = numpy.arange(len(alleles))
+    first = alleles[rows, haplotypes[0]]
+    second = alleles[rows, haplotypes[1]]
+    haploid = chromosome == 'MT' or (person.sex == 'M' and chromosome in ('X', 'Y'))
+    missing = rng.random(len(alleles)) < no_call_rate
+    if chromosome == 'Y' and person.sex == 'F':
+        missing[:] = True
+    first = numpy.where(missing, '-', first)
+    second = numpy.where(haploid, '', numpy.where(missing, '-', second))
+    return first.tolist(), second.tolist()
+
+def write_person(person, filename, file_format, marker_table):
+    lines = []
+    for chromosome, chromosome_markers in marker_table.items():
+        first, second = genotype_strings(person, chromosome, chromosome_markers)
+        if file_format == 'ancestry':
+            second = [allele or first_allele for first_allele, allele in zip(first, second)]
+            genotypes = [
+                ('0\t0' if first_allele == '-' else first_allele + '\t' + second_allele)
+                for first_allele, second_allele in zip(first, second)
+            ]
+            delimiter = '\t'
+        elif file_format == 'ftdna':
+            genotypes = ['"' + genotype + '"' for genotype in map(add, first, second)]
+            delimiter = ','
+        else:
+            genotypes = list(map(add, first, second))
+            delimiter = '\t'
+        if file_format == 'ftdna':
+            prefixes = [
+                '"' + rsid + '","' + chromosome + '","' + str(bp) + '",'
+                for rsid, bp in zip(chromosome_markers['rsids'], chromosome_markers['bp'].tolist())
+            ]
+        else:
+            prefixes = [
+                rsid + delimiter + chromosome + delimiter + str(bp) + delimiter
+                for rsid, bp in zip(chromosome_markers['rsids'], chromosome_markers['bp'].tolist())
+            ]
+        lines += map(add, prefixes, genotypes)
+
+    with open(filename, 'w') as raw_file:
+        if file_format == 'ancestry':
+            raw_file.write('#AncestryDNA raw data download\n')
+            raw_file.write('rsid\tchromosome\tposition\tallele1\tallele2\n')
+        elif file_format == 'ftdna':
+            raw_file.write('RSID,CHROMOSOME,POSITION,RESULT\n')
+        else:
+            raw_file.write('# This data file generated by 23andMe\n#\n')
+            raw_file.write('# rsid\tchromosome\tposition\tgenotype\n')
+        raw_file.write('\n'.join(lines) + '\n')
+
+def write_raw_data(people, marker_table):
+    '''
+    Write every person's raw data file into the cases, controls or unknowns
+    directory, in 23andMe, Ancestry.com or FTDNA format, and return the number
+    of files of each format.
+    '''
+    for directory in ('cases', 'controls', 'unknowns'):
+        os.makedirs(out_dir + '/' + directory, exist_ok=True)
+    format_counts = dict.fromkeys(FORMATS, 0)
+    for person in people:
+        directory = rng.choice(['cases', 'controls', 'unknowns'], p=[0.4, 0.4, 0.2])
+        draw = rng.random()
+        if draw < ancestry_fraction:
+            file_format = 'ancestry'
+        elif draw < ancestry_fraction + ftdna_fraction:
+            file_format = 'ftdna'
+        else:
+            file_format = '23andme'
+        extension = '.csv' if file_format == 'ftdna' else '.txt'
+        write_person(person, out_dir + '/' + directory + '/' + person.name + extension, file_format, marker_table)
+        format_counts[file_format] += 1
+    return format_counts
+
+def write_comparisons(hap_map, marker_table):
+    '''
+    Write a relative comparison CSV for each relative of a proband into
+    linkage/cases or linkage/controls. A relative shares a few segments of
+    random length with the proband, and the cases are more likely than the
+    controls to share a segment over LINKED_RANGE. Return the number of
+    segments written.
+    '''
+    for directory in ('cases', 'controls'):
+        os.makedirs(out_dir + '/linkage/' + directory, exist_ok=True)
+    lengths = numpy.array([CHROMOSOME_LENGTHS[chromosome] for chromosome in MAPPED_CHROMOSOMES], dtype=float)
+    num_segments = 0
+    for relative in range(relatives):
+        is_case = relative % 2 == 0
+        segments = []
+        chromosomes = rng.choice(MAPPED_CHROMOSOMES, rng.integers(1, 30), p=lengths / lengths.sum())
+        for chromosome in chromosomes.tolist():
+            start = int(rng.integers(1, CHROMOSOME_LENGTHS[chromosome]))
+            end = min(start + int(rng.exponential(10000000)), CHROMOSOME_LENGTHS[chromosome])
+            segments.append((chromosome, start, end))
+        if rng.random() < (0.7 if is_case else 0.2):
+            start = LINKED_RANGE[0] - int(rng.integers(0, 5000000))
+            end = LINKED_RANGE[1] + int(rng.integers(0, 5000000))
+            segments.append((LINKED_CHROMOSOME, start, end))
+
+        #a relative's segments do not overlap each other
+        segments.sort(key=lambda segment: (MAPPED_CHROMOSOMES.index(segment[0]), segment[1]))
+        kept = []
+        for chromosome, start, end in segments:
+            if kept and kept[-1][0] == chromosome and start <= kept[-1][2]:
+                continue
+            kept.append((chromosome, start, end))
+
+        name = 'relative' + str(relative + 1)
+        directory = out_dir + '/linkage/' + ('cases' if is_case else 'controls')
+        with open(directory + '/' + name + '.csv', 'w') as csv_file:
+            csv_file.write('Comparison,Chromosome,Start Point,End Point,Genetic Distance,#SNPs\n')
+            for chromosome, start, end in kept:
+                start_cm, end_cm = centimorgans(hap_map, chromosome, [start, end])
+                bp_positions = marker_table[chromosome]['bp']
+                snps = numpy.searchsorted(bp_positions, end, side='right') - numpy.searchsorted(bp_positions, start)
+                csv_file.write(
+                    'You vs ' + name + ',' + chromosome + ',' + str(start) + ',' + str(end) + ',' +
+                    str(round(end_cm - start_cm, 2)) + ',' + str(snps) + '\n'
+                )
+        num_segments += len(kept)
+    return num_segments
+
+os.makedirs(out_dir, exist_ok=True)
+hap_map = write_hap_maps()
+marker_table = make_markers(hap_map)
+people = make_families(marker_table)
+format_counts = write_raw_data(people, marker_table)
+num_segments = write_comparisons(hap_map, marker_table)
+
+with open(out_dir + '/cohort.json', 'w') as manifest_file:
+    json.dump({
+        'seed': seed,
+        'families': families,
+        'people': len(people),
+        'markers': sum(len(chromosome_markers['bp']) for chromosome_markers in marker_table.values()),
+        'formats': format_counts,
+        'relatives': relatives,
+        'segments': num_segments,
+    }, manifest_file, indent=4)
+    manifest_file.write('\n')
@@ -1,40 +1,64 @@
 #!/usr/bin/python3
 
-import csv
-from collections import OrderedDict
-from sys import argv
+import sys
+from getopt import getopt
+from os.path import dirname
+from os.path import join
+from os.path import realpath
+from tempfile import TemporaryDirectory
 
-rows_to_ignore = [
-    ['rsid', 'chromosome', 'position', 'allele1', 'allele2'], #Ancestry.com
-    ['Name', 'Variation', 'Chromosome', 'Position', 'Strand', 'YourCode'], #deCODEme
-    ['RSID', 'CHROMOSOME', 'POSITION', 'RESULT'], #FTDNA
-]
+#the raw data parser shared with convert.py is in the convert directory
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'convert'))
 
-all_snps = set()
-snps_by_file = []
+from comparison import SUMMARIES
+from comparison import compare_in_memory
+from comparison import compare_streamed
+from comparison import lookup
+from comparison import write_index
+from comparison import write_summary
+from comparison import write_table
 
-for filename in argv[1:]:
-    snps_in_file = set()
-    if filename.endswith('.csv'):
-        delimiter = ','
+stream = False
+summary = None
+index_filename = None
+lookup_filename = None
+block_size = 1 << 16
+
+optlist, filenames = getopt(sys.argv[1:], '', ['stream', 'summary=', 'index=', 'lookup=', 'help'])
+for name, value in optlist:
+    if name == '--stream':
+        stream = True
+    elif name == '--index':
+        index_filename = value
+    elif name == '--lookup':
+        lookup_filename = value
+    elif name == '--summary':
+        if value not in SUMMARIES:
+            sys.stderr.write('Unknown summary: ' + value + '\n')
+            exit(1)
+        summary = value
+    elif name == '--help':
+        print('Syntax: ./comparison-matrix.py [--stream] [--summary=(counts|overlap|jaccard|unique)]')
+        print('                               [--index=<file>] <file>...')
+        print('        ./comparison-matrix.py --lookup=<file> [<rsid>...]')
+        print('With --lookup, the rsids are read from standard input if none are given.')
+        exit()
+
+if lookup_filename:
+    if filenames:
+        lookup(lookup_filename, filenames)
     else:
-        delimiter = '\t'
-    for row in csv.reader(open(filename, 'r'), delimiter=delimiter):
-        if row[0].startswith('#'):
-            continue
-        if row in rows_to_ignore:
-            continue
-        rsid = row[0]
-        all_snps.add(rsid)
-        snps_in_file.add(rsid)
-    snps_by_file.append(snps_in_file)
+        lookup(lookup_filename, (line.strip() for line in sys.stdin if line.strip()))
+    exit()
 
-print('\t' + '\t'.join(argv[1:]))
-for rsid in sorted(all_snps):
-    availability = []
-    for snps_in_file in snps_by_file:
-        if rsid in snps_in_file:
-            availability.append('Yes')
-        else:
-            availability.append('No')
-    print(rsid + '\t' + '\t'.join(availability))
+with TemporaryDirectory() as temp_dir:
+    if stream:
+        chunks = compare_streamed(filenames, temp_dir, block_size)
+    else:
+        chunks = compare_in_memory(filenames)
+    if summary:
+        write_summary(chunks, filenames, summary, block_size)
+    elif index_filename:
+        write_index(chunks, filenames, index_filename, temp_dir)
+    else:
+        write_table(chunks, filenames)
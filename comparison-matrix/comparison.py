@@ -0,0 +1,185 @@
+import json
+import mmap
+import numpy
+import shutil
+import sys
+from rawdata import read_rsids
+
+SUMMARIES = ('counts', 'overlap', 'jaccard', 'unique')
+
+INDEX_MAGIC = b'RSIDIDX\0'
+INDEX_VERSION = 1
+
+def availability_bits(all_snps, snps_by_file):
+    '''
+    Return a packed bit matrix with one row per marker in the sorted array
+    all_snps and one bit per file, set if the file has the marker. The first
+    file is the lowest bit of the first byte of each row.
+    '''
+    present = numpy.zeros((len(all_snps), len(snps_by_file)), dtype=bool)
+    for i, snps_in_file in enumerate(snps_by_file):
+        present[:, i] = numpy.isin(all_snps, snps_in_file, assume_unique=True)
+    return numpy.packbits(present, axis=1, bitorder='little')
+
+def unpack(bits, num_files):
+    return numpy.unpackbits(bits, axis=1, count=num_files, bitorder='little')
+
+def compare_in_memory(filenames):
+    snps_by_file = [numpy.unique(read_rsids(filename)) for filename in filenames]
+    all_snps = numpy.unique(numpy.concatenate(snps_by_file + [numpy.array([], dtype='S1')]))
+    yield all_snps, availability_bits(all_snps, snps_by_file)
+
+def compare_streamed(filenames, temp_dir, block_size=1 << 16):
+    '''
+    Like compare_in_memory, but sort the rsids of each file into a run on disk
+    and merge the memory-mapped runs a block at a time, so only one block of
+    each run is in memory at once.
+    '''
+    runs = []
+    for i, filename in enumerate(filenames):
+        numpy.save(temp_dir + '/' + str(i) + '.npy', numpy.unique(read_rsids(filename)))
+        runs.append(numpy.load(temp_dir + '/' + str(i) + '.npy', mmap_mode='r'))
+
+    #every chunk has the same rsid width, however long the rsids in it are
+    rsid_dtype = numpy.dtype('S' + str(max([run.dtype.itemsize for run in runs] + [1])))
+    cursors = [0] * len(runs)
+    while any(cursor < len(run) for cursor, run in zip(cursors, runs)):
+        blocks = [run[cursor:cursor + block_size] for cursor, run in zip(cursors, runs)]
+        #every rsid up to the smallest last rsid of the blocks that do not reach the end of their runs is in a block
+        last_rsids = [
+            block[-1] for cursor, run, block in zip(cursors, runs, blocks) if cursor + len(block) < len(run)
+        ]
+        if last_rsids:
+            limit = min(last_rsids)
+            blocks = [block[:numpy.searchsorted(block, limit, side='right')] for block in blocks]
+        all_snps = numpy.unique(numpy.concatenate(blocks)).astype(rsid_dtype)
+        yield all_snps, availability_bits(all_snps, blocks)
+        cursors = [cursor + len(block) for cursor, block in zip(cursors, blocks)]
+
+def write_table(chunks, filenames):
+    #every row with the same bits gets the same Yes/No columns, so build those once per distinct row
+    out = sys.stdout.buffer
+    out.write(('\t' + '\t'.join(filenames) + '\n').encode())
+    for all_snps, bits in chunks:
+        patterns, rows = numpy.unique(bits, axis=0, return_inverse=True)
+        columns = [
+            ''.join('\tYes' if present else '\tNo' for present in pattern).encode() + b'\n'
+            for pattern in unpack(patterns, len(filenames)).tolist()
+        ]
+        out.write(b''.join([rsid + columns[row] for rsid, row in zip(all_snps.tolist(), rows.ravel().tolist())]))
+
+def write_summary(chunks, filenames, summary, block_size=1 << 16):
+    '''
+    Write one of the summaries: the number of markers in each file and how many
+    of them are in no other file (counts), the number of markers that each pair
+    of files has in common (overlap), the Jaccard index of each pair of files
+    (jaccard), or each marker that is only in one file, with that file (unique).
+    '''
+    num_files = len(filenames)
+    overlap = numpy.zeros((num_files, num_files), dtype=numpy.int64)
+    unique_counts = numpy.zeros(num_files, dtype=numpy.int64)
+    if summary == 'unique':
+        print('Marker\tFile')
+    for all_snps, bits in chunks:
+        for start in range(0, len(all_snps), block_size):
+            present = unpack(bits[start:start + block_size], num_files)
+            #exact for any count below 2**24 in a block
+            matrix = present.astype(numpy.float32)
+            overlap += numpy.rint(matrix.T @ matrix).astype(numpy.int64)
+            only_one = present.sum(axis=1) == 1
+            unique_counts += present[only_one].sum(axis=0, dtype=numpy.int64)
+            if summary == 'unique':
+                files = present[only_one].argmax(axis=1)
+                sys.stdout.write(''.join(
+                    rsid.decode() + '\t' + filenames[file] + '\n'
+                    for rsid, file in zip(all_snps[start:start + block_size][only_one].tolist(), files.tolist())
+                ))
+
+    if summary == 'counts':
+        print('File\tMarkers\tUnique markers')
+        for i, filename in enumerate(filenames):
+            print(filename + '\t' + str(overlap[i, i]) + '\t' + str(unique_counts[i]))
+    elif summary in ('overlap', 'jaccard'):
+        if summary == 'jaccard':
+            union = overlap.diagonal()[:, None] + overlap.diagonal()[None, :] - overlap
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                table = overlap / union
+        else:
+            table = overlap
+        print('\t' + '\t'.join(filenames))
+        for filename, row in zip(filenames, table.tolist()):
+            print(filename + '\t' + '\t'.join(map(str, row)))
+
+def write_index(chunks, filenames, index_filename, temp_dir):
+    '''
+    Write a binary index of the markers: INDEX_MAGIC, the length of a JSON
+    header as a little-endian 64-bit integer, the header itself, the sorted
+    rsids as fixed-width strings, and the packed bit row of each rsid. The
+    header is padded so that the rsids start on an 8-byte boundary.
+    '''
+    count = 0
+    rsid_width = 1
+    with open(temp_dir + '/rsids', 'wb') as rsids_file, open(temp_dir + '/bits', 'wb') as bits_file:
+        for all_snps, bits in chunks:
+            rsid_width = all_snps.dtype.itemsize
+            rsids_file.write(all_snps.tobytes())
+            bits_file.write(bits.tobytes())
+            count += len(all_snps)
+
+    header = json.dumps({
+        'version': INDEX_VERSION,
+        'files': filenames,
+        'count': count,
+        'rsid_width': rsid_width,
+        'row_bytes': (len(filenames) + 7) // 8,
+    }).encode()
+    header += b' ' * (-len(header) % 8)
+    with open(index_filename, 'wb') as index_file:
+        index_file.write(INDEX_MAGIC + len(header).to_bytes(8, 'little') + header)
+        for part in ('/rsids', '/bits'):
+            with open(temp_dir + part, 'rb') as part_file:
+                shutil.copyfileobj(part_file, index_file, 1 << 20)
+
+def open_index(filename):
+    '''
+    Memory-map an index written by write_index and return its file names, its
+    sorted rsids and its bit rows, without reading the rsids or the bit rows
+    into memory.
+    '''
+    with open(filename, 'rb') as index_file:
+        mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise ValueError(filename + ' is not an rsid index')
+    header_length = int.from_bytes(mapped[len(INDEX_MAGIC):len(INDEX_MAGIC) + 8], 'little')
+    offset = len(INDEX_MAGIC) + 8
+    header = json.loads(mapped[offset:offset + header_length].decode())
+    if header['version'] != INDEX_VERSION:
+        raise ValueError(filename + ' is an rsid index of an unsupported version')
+    offset += header_length
+    count = header['count']
+    rsids = numpy.frombuffer(mapped, dtype='S' + str(header['rsid_width']), count=count, offset=offset)
+    offset += count * header['rsid_width']
+    bits = numpy.frombuffer(mapped, dtype=numpy.uint8, count=count * header['row_bytes'], offset=offset)
+    return header['files'], rsids, bits.reshape(count, header['row_bytes'])
+
+def lookup(index_filename, queries):
+    '''
+    Write the spreadsheet rows of the rsids in queries, found by binary search
+    over the memory-mapped index. An rsid that is not in the index is in none
+    of the files.
+    '''
+    files, rsids, bits = open_index(index_filename)
+    queries = [query.encode() for query in queries]
+    keys = numpy.array(queries, dtype=rsids.dtype)
+    positions = numpy.minimum(numpy.searchsorted(rsids, keys), max(len(rsids) - 1, 0))
+    found = numpy.array([len(query) <= rsids.dtype.itemsize for query in queries], dtype=bool)
+    if len(rsids) > 0:
+        found &= rsids[positions] == keys
+    else:
+        found[:] = False
+    rows = numpy.zeros((len(queries), bits.shape[1]), dtype=numpy.uint8)
+    rows[found] = bits[positions[found]]
+
+    print('\t' + '\t'.join(files))
+    for query, row in zip(queries, numpy.unpackbits(rows, axis=1, count=len(files), bitorder='little').tolist()):
+        print(query.decode() + ''.join('\tYes' if present else '\tNo' for present in row))
@@ -0,0 +1,457 @@
+import numpy
+import re
+from collections import OrderedDict
+from functools import partial
+from glob import glob
+from math import inf
+from os.path import basename
+from os.path import getsize
+from os.path import splitext
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from genotypes import ABSENT
+from genotypes import GenotypeStore
+from genotypes import NO_CALL
+from hapmap import interpolate
+from jobs import map_jobs
+from output import write_map_files
+from output import write_ped
+from plink import write_bed
+from profiling import Profiler
+from profiling import timed
+from rawdata import index_file
+from rawdata import parse_file
+from rawdata import parse_file_cached
+from rawdata import parse_file_ranges
+from rawdata import strip_compression
+from relatedness import match_totals
+
+MALE = '1'
+FEMALE = '2'
+
+PARENT_OR_CHILD = 'Parent/Child'
+SIBLING = 'Sibling'
+
+AUTOSOMES = list(map(str, range(1, 23)))
+
+def locate_markers(snp_map, hap_map):
+    rsids_by_chromosome = OrderedDict()
+    for rsid in snp_map:
+        rsids_by_chromosome.setdefault(snp_map[rsid][0], []).append(rsid)
+
+    for chromosome, rsids in rsids_by_chromosome.items():
+        if not chromosome in hap_map:
+            continue
+        bp_positions = [snp_map[rsid][1] for rsid in rsids]
+        cm_positions = interpolate(hap_map, chromosome, bp_positions).tolist()
+        for rsid, bp_pos, cm_pos in zip(rsids, bp_positions, cm_positions):
+            snp_map[rsid] = (chromosome, bp_pos, cm_pos)
+
+def merge_file(raw_data, snp_map, person_id, parsed_file):
+    rsids, chromosomes, bp_positions, genotypes, file_codes = parsed_file
+    code_map = numpy.array([raw_data.code(bases) for bases in genotypes], dtype=numpy.uint8)
+
+    #files from the same chip list the same markers, so only look up each list once
+    columns = raw_data.find_layout(rsids, chromosomes)
+    if columns is None:
+        columns = numpy.empty(len(rsids), dtype=numpy.intp)
+        for i, (rsid, chromosome) in enumerate(zip(rsids.tolist(), chromosomes.tolist())):
+            rsid = rsid.decode()
+            chromosome = chromosome.decode()
+            if not rsid in snp_map:
+                snp_map[rsid] = (chromosome, int(bp_positions[i]), 0)
+                raw_data.add_marker(rsid)
+            elif snp_map[rsid][0] != chromosome:
+                columns[i] = -1
+                continue
+            columns[i] = raw_data.columns[rsid]
+        raw_data.add_layout(rsids, chromosomes, columns)
+
+    found = columns >= 0
+    if numpy.count_nonzero(found) > 0:
+        raw_data.set_calls(person_id, columns[found], code_map[file_codes[found]])
+
+def person_id_of(filename):
+    return re.sub('\W', '', splitext(basename(strip_compression(filename)))[0])
+
+def list_files(dirs_and_affections, recursive=False):
+    #(filename, person ID, affection) of each file in each (directory, affection) pair
+    files = []
+    for txt_dir, affection in dirs_and_affections:
+        for filename in sorted(glob(txt_dir + '/**', recursive=recursive)):
+            files.append((filename, person_id_of(filename), affection))
+    return files
+
+def count_y_calls(raw_data, snp_map):
+    y_calls = {}
+    y_columns = [raw_data.columns[rsid] for rsid in snp_map if snp_map[rsid][0] == 'Y']
+    for person_id in raw_data:
+        calls = raw_data.calls(person_id, y_columns)
+        y_calls[person_id] = (int(numpy.count_nonzero(calls > NO_CALL)), int(numpy.count_nonzero(calls != ABSENT)))
+    return y_calls
+
+def classify_relationships(person_ids, half_matches, full_matches, possible_matches):
+    relationship_table = {}
+    for person_id in person_ids:
+        relationship_table[person_id] = {}
+    for person1_index, person1_id in enumerate(person_ids):
+        for person2_index in range(person1_index + 1, len(person_ids)):
+            person2_id = person_ids[person2_index]
+            half_match_ratio = float(half_matches[person1_index][person2_index]) / float(possible_matches[person1_index][person2_index])
+            full_match_ratio = float(full_matches[person1_index][person2_index]) / float(possible_matches[person1_index][person2_index])
+
+            '''
+            print(person1_id + ' to ' + person2_id + ':' +
+                ' half ' + str(half_match_ratio) +
+                ' full ' + str(full_match_ratio))
+            #'''
+            if half_match_ratio > 0.98:
+                relationship_table[person1_id][person2_id] = PARENT_OR_CHILD
+                relationship_table[person2_id][person1_id] = PARENT_OR_CHILD
+            elif full_match_ratio > 0.70:
+                relationship_table[person1_id][person2_id] = SIBLING
+                relationship_table[person2_id][person1_id] = SIBLING
+
+    #print(relationship_table)
+    return relationship_table
+
+def count_relationships(relationship_table, counts):
+    #every relationship is in the table twice, once for each person, so only count it from the first
+    for person1_id, relationships in relationship_table.items():
+        for person2_id, relationship in relationships.items():
+            if person1_id > person2_id:
+                continue
+            if relationship == PARENT_OR_CHILD:
+                counts['parent_child_pairs'] += 1
+            elif relationship == SIBLING:
+                counts['sibling_pairs'] += 1
+
+class Converter:
+    '''
+    Convert raw data files to PLINK and MERLIN files. The settings are those of
+    the options of convert.py, and hap_map is a genetic map from load_hap_map,
+    which can be shared by any number of converters. After a conversion, the
+    sex, parents and affection of each person are in sex_table, parents_table
+    and affection_table. Each step of a conversion is timed as a phase of
+    profiler.
+    '''
+
+    def __init__(self, hap_map, family_id='FAM001', out_dir='.', want_parents=True, want_sexes=True, spacing=0,
+                 chromosome_of_interest=None, start_pos=0, end_pos=inf, output_format='ped', jobs=1,
+                 cache_dir=None, profiler=None):
+        self.hap_map = hap_map
+        self.family_id = family_id
+        self.out_dir = out_dir
+        #the parents are found from the sexes
+        self.want_parents = want_parents and want_sexes
+        self.want_sexes = want_sexes
+        self.spacing = spacing
+        self.chromosome_of_interest = chromosome_of_interest
+        self.start_pos = start_pos
+        self.end_pos = end_pos
+        self.output_format = output_format
+        self.jobs = jobs
+        if cache_dir:
+            self.parse_file = partial(parse_file_cached, cache_dir=cache_dir)
+        else:
+            self.parse_file = parse_file
+        self.profiler = profiler or Profiler()
+        self.affection_table = {}
+        self.sex_table = {}
+        self.parents_table = {}
+
+    def ingest(self, raw_data, snp_map, person_id, filename, parsed_file, parse_time, counts):
+        #merge a parsed file, counting its lines and how fast it was read and merged
+        start = perf_counter()
+        merge_file(raw_data, snp_map, person_id, parsed_file)
+        lines = len(parsed_file[0])
+        counts['lines'] += lines
+        self.profiler.add_file(filename, getsize(filename), lines, parse_time + perf_counter() - start)
+
+    def parse(self, files):
+        '''
+        Parse the raw data files in files, a list of (filename, person ID,
+        affection) tuples from list_files, and return a GenotypeStore of
+        everyone's genotypes and a map of each marker's rsid to its
+        (chromosome, base pair position, centimorgan position).
+        '''
+        raw_data = GenotypeStore()
+        snp_map = OrderedDict()
+        with self.profiler.phase('parse') as counts:
+            parsed_files = map_jobs(
+                partial(timed, self.parse_file), [filename for filename, person_id, affection in files], self.jobs
+            )
+            for (filename, person_id, affection), (parsed_file, parse_time) in zip(files, parsed_files):
+                self.affection_table[person_id] = affection
+                self.ingest(raw_data, snp_map, person_id, filename, parsed_file, parse_time, counts)
+            locate_markers(snp_map, self.hap_map)
+            counts['files'] += len(files)
+            counts['bytes'] += sum(getsize(filename) for filename, person_id, affection in files)
+            counts['markers'] += len(snp_map)
+            counts['people'] += len(raw_data)
+        return raw_data, snp_map
+
+    def infer_sexes(self, y_calls):
+        #y_calls is from count_y_calls
+        with self.profiler.phase('sexes') as counts:
+            for person_id, (male_snps, total_snps) in y_calls.items():
+                if male_snps / total_snps > 0.1:
+                    self.sex_table[person_id] = MALE
+                else:
+                    self.sex_table[person_id] = FEMALE
+            counts['people'] += len(y_calls)
+
+    def infer_parents(self, person_ids, relationship_table):
+        #returns the IDs of the parents that have to be added because they have no raw data
+        missing_parent_ids = []
+        for proband_id in person_ids:
+            father_id = '0'
+            mother_id = '0'
+            for potential_parent_id in relationship_table[proband_id]:
+                if relationship_table[proband_id][potential_parent_id] != PARENT_OR_CHILD:
+                    continue
+                for sibling_id in relationship_table[proband_id]:
+                    if relationship_table[proband_id][sibling_id] != SIBLING:
+                        continue
+                    if (potential_parent_id in relationship_table[sibling_id] and
+                            relationship_table[sibling_id][potential_parent_id] == PARENT_OR_CHILD):
+                        if self.sex_table[potential_parent_id] == MALE:
+                            father_id = potential_parent_id
+                        else:
+                            mother_id = potential_parent_id
+                        if mother_id != '0' and father_id != '0':
+                            break
+                if mother_id != '0' and father_id != '0':
+                    break
+
+            if father_id == '0' and mother_id != '0':
+                missing_parent_id = mother_id + 'Spouse'
+                missing_parent_sex = MALE
+                father_id = missing_parent_id
+            elif mother_id == '0' and father_id != '0':
+                missing_parent_id = father_id + 'Spouse'
+                missing_parent_sex = FEMALE
+                mother_id = missing_parent_id
+            else:
+                missing_parent_id = None
+
+            self.parents_table[proband_id] = (father_id, mother_id)
+
+            if missing_parent_id and missing_parent_id not in person_ids and missing_parent_id not in missing_parent_ids:
+                self.affection_table[missing_parent_id] = '0'
+                self.sex_table[missing_parent_id] = missing_parent_sex
+                self.parents_table[missing_parent_id] = ('0', '0')
+                missing_parent_ids.append(missing_parent_id)
+        return missing_parent_ids
+
+    def infer_relationships(self, person_ids, half_matches, full_matches, possible_matches):
+        '''
+        Classify the relationship of each pair of people from the match totals
+        of match_totals, fill in everyone's parents, and return the IDs of the
+        parents that have to be added because they have no raw data.
+        '''
+        with self.profiler.phase('relationships') as counts:
+            relationship_table = classify_relationships(person_ids, half_matches, full_matches, possible_matches)
+            missing_parent_ids = self.infer_parents(list(person_ids), relationship_table)
+            counts['pairs'] += len(person_ids) * (len(person_ids) - 1) // 2
+            count_relationships(relationship_table, counts)
+            counts['missing_parents'] += len(missing_parent_ids)
+        return missing_parent_ids
+
+    def want_thinning(self):
+        return self.spacing > 0 or self.chromosome_of_interest or self.start_pos > 0 or self.end_pos < inf
+
+    def thin(self, snp_map):
+        with self.profiler.phase('thinning') as counts:
+            new_snp_map = OrderedDict()
+            prev_chromosome = None
+            next_cm_pos = 0
+
+            for rsid in snp_map:
+                if (self.chromosome_of_interest and (snp_map[rsid][0] != self.chromosome_of_interest or
+                        snp_map[rsid][2] < self.start_pos or snp_map[rsid][2] > self.end_pos)):
+                    continue
+
+                if snp_map[rsid][0] != prev_chromosome:
+                    next_cm_pos = 0
+                    prev_chromosome = snp_map[rsid][0]
+
+                if snp_map[rsid][2] >= next_cm_pos:
+                    new_snp_map[rsid] = snp_map[rsid]
+                    next_cm_pos += self.spacing
+
+            counts['markers_before'] += len(snp_map)
+            counts['markers_after'] += len(new_snp_map)
+        return new_snp_map
+
+    def build_pedigree(self, person_ids):
+        pedigree = []
+        for proband_id in person_ids:
+            if self.want_parents:
+                father_id = self.parents_table[proband_id][0]
+                mother_id = self.parents_table[proband_id][1]
+            else:
+                father_id = '0'
+                mother_id = '0'
+
+            if self.want_sexes:
+                sex = self.sex_table[proband_id]
+            else:
+                sex = '0'
+
+            pedigree.append((self.family_id, proband_id, father_id, mother_id, sex, self.affection_table[proband_id]))
+        return pedigree
+
+    def output_filenames(self):
+        if self.output_format == 'bed':
+            extensions = ('.bed', '.bim', '.fam')
+        else:
+            extensions = ('.ped', '.plink.map', '.merlin.map', '.merlin.dat')
+        return [self.out_dir + '/' + self.family_id + extension for extension in extensions]
+
+    def write(self, person_ids, genotypes, snp_map, pieces):
+        '''
+        Write the output files of the people in person_ids. pieces is a list of
+        (rsids, matrix, columns) tuples, where each row of matrix is a person's
+        genotype codes and columns are the columns of the rsids in it.
+        '''
+        with self.profiler.phase('writing') as counts:
+            pedigree = self.build_pedigree(person_ids)
+            if self.output_format == 'bed':
+                write_bed(self.out_dir + '/' + self.family_id, pedigree, genotypes, snp_map, pieces)
+            else:
+                write_ped(self.out_dir + '/' + self.family_id + '.ped', pedigree, genotypes, pieces)
+                write_map_files(self.out_dir + '/' + self.family_id, snp_map)
+            counts['people'] += len(pedigree)
+            counts['markers'] += len(snp_map)
+            counts['bytes'] += sum(getsize(filename) for filename in self.output_filenames())
+
+    def convert(self, files):
+        #files is a list of (filename, person ID, affection) tuples from list_files
+        print('Loading 23andMe raw data files...')
+
+        raw_data, snp_map = self.parse(files)
+
+        if self.want_sexes:
+            print('Inferring sexes...')
+            self.infer_sexes(count_y_calls(raw_data, snp_map))
+
+        if self.want_parents:
+            print('Inferring relationships...')
+            with self.profiler.phase('relationships') as counts:
+                match_sums = match_totals(raw_data, snp_map, self.hap_map, AUTOSOMES)
+                counts['markers'] += sum(1 for rsid in snp_map if snp_map[rsid][0] in AUTOSOMES)
+            for missing_parent_id in self.infer_relationships(*match_sums):
+                raw_data.fill(missing_parent_id, NO_CALL)
+
+        if self.want_thinning():
+            print('Thinning the data...')
+            snp_map = self.thin(snp_map)
+
+        print('Writing files...')
+
+        columns = numpy.array([raw_data.columns[rsid] for rsid in snp_map], dtype=numpy.intp)
+        self.write(list(raw_data), raw_data.genotypes, snp_map, [(list(snp_map), raw_data.matrix, columns)])
+
+    def convert_by_chromosome(self, files):
+        '''
+        Make one pass over the raw data files per chromosome, holding only that
+        chromosome's genotypes in memory. Each pass adds to the relatedness
+        totals, and its thinned genotypes are saved to a temporary file in the
+        output directory until the pedigree is known and the output files can
+        be written. The chromosomes are written in the order that they first
+        appear in the files.
+        '''
+        print('Indexing 23andMe raw data files...')
+
+        raw_data = GenotypeStore()
+        snp_map = OrderedDict()
+        chromosomes = OrderedDict()
+
+        with self.profiler.phase('index') as counts:
+            file_indexes = []
+            indexed_files = map_jobs(
+                partial(timed, index_file), [filename for filename, person_id, affection in files], self.jobs
+            )
+            for (filename, person_id, affection), ((file_index, header_type), index_time) in zip(files, indexed_files):
+                file_indexes.append((file_index, header_type))
+                self.affection_table[person_id] = affection
+                if len(file_index) > 0:
+                    raw_data.add_person(person_id)
+                for chromosome in file_index:
+                    chromosomes[chromosome] = True
+                self.profiler.add_file(filename, getsize(filename), 0, index_time)
+            counts['files'] += len(files)
+            counts['bytes'] += sum(getsize(filename) for filename, person_id, affection in files)
+            counts['chromosomes'] += len(chromosomes)
+
+        person_ids = list(raw_data)
+        y_calls = {}
+        match_sums = None
+        pieces = []
+        temp_dir = TemporaryDirectory(dir=self.out_dir)
+
+        for chromosome in chromosomes:
+            if (self.chromosome_of_interest not in (None, chromosome) and
+                    not (self.want_sexes and chromosome == 'Y') and
+                    not (self.want_parents and chromosome in AUTOSOMES)):
+                continue
+
+            print('Loading chromosome ' + chromosome + '...')
+
+            with self.profiler.phase('parse') as counts:
+                raw_data.reset_markers()
+                chromosome_snp_map = OrderedDict()
+
+                arguments = [
+                    (filename, file_index.get(chromosome, []), header_type)
+                    for (filename, person_id, affection), (file_index, header_type) in zip(files, file_indexes)
+                ]
+                parsed_files = map_jobs(partial(timed, parse_file_ranges), arguments, self.jobs)
+                for (filename, person_id, affection), (parsed_file, parse_time) in zip(files, parsed_files):
+                    self.ingest(raw_data, chromosome_snp_map, person_id, filename, parsed_file, parse_time, counts)
+                locate_markers(chromosome_snp_map, self.hap_map)
+                counts['markers'] += len(chromosome_snp_map)
+                counts['chromosomes'] += 1
+
+            if self.want_sexes and chromosome == 'Y':
+                with self.profiler.phase('sexes'):
+                    y_calls = count_y_calls(raw_data, chromosome_snp_map)
+
+            if self.want_parents and chromosome in AUTOSOMES:
+                with self.profiler.phase('relationships') as counts:
+                    chromosome_sums = match_totals(raw_data, chromosome_snp_map, self.hap_map, [chromosome])[1:]
+                    if match_sums is None:
+                        match_sums = chromosome_sums
+                    else:
+                        match_sums = [total + chromosome_total for total, chromosome_total in zip(match_sums, chromosome_sums)]
+                    counts['markers'] += len(chromosome_snp_map)
+
+            if self.want_thinning():
+                chromosome_snp_map = self.thin(chromosome_snp_map)
+            if len(chromosome_snp_map) == 0:
+                continue
+
+            with self.profiler.phase('writing'):
+                columns = [raw_data.columns[rsid] for rsid in chromosome_snp_map]
+                piece_filename = temp_dir.name + '/chr' + chromosome + '.npy'
+                numpy.save(piece_filename, raw_data.matrix[:, columns])
+                rsids = list(chromosome_snp_map)
+                pieces.append((rsids, numpy.load(piece_filename, mmap_mode='r'), numpy.arange(len(rsids))))
+                snp_map.update(chromosome_snp_map)
+
+        if self.want_sexes:
+            print('Inferring sexes...')
+            self.infer_sexes(y_calls)
+
+        if self.want_parents:
+            print('Inferring relationships...')
+            if match_sums is None:
+                match_sums = [numpy.zeros((len(person_ids), len(person_ids)))] * 3
+            person_ids += self.infer_relationships(person_ids, *match_sums)
+
+        print('Writing files...')
+
+        self.write(person_ids, raw_data.genotypes, snp_map, pieces)
+        pieces.clear()
+        temp_dir.cleanup()
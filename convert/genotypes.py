@@ -0,0 +1,104 @@
+import numpy
+
+ABSENT = 0 #the marker is not in the person's raw data file
+NO_CALL = 1 #the marker is in the file but was not called
+
+class GenotypeStore:
+    '''
+    The genotypes of every person at every marker, kept in a dense people x
+    markers matrix with one byte per call. Each byte is a code into a small
+    table of (base1, base2) tuples that is shared by all people, and each
+    column is a marker in the order that it was first seen.
+
+    Memory budget: one byte per marker per person, so about 0.6 MB for each
+    23andMe file of 600,000 markers, or 1 GB for a cohort of about 1,700
+    people. The matrix grows by doubling, so up to twice that much may be
+    reserved while files are being loaded. The marker index is shared by all
+    people and costs about 100 bytes per marker regardless of cohort size.
+    '''
+
+    def __init__(self):
+        self.person_ids = []
+        self.rows = {}
+        self.columns = {}
+        self.layouts = []
+        self.genotypes = [('0', '0'), ('0', '0')]
+        self.codes = {('0', '0'): NO_CALL}
+        self._matrix = numpy.zeros((0, 0), dtype=numpy.uint8)
+
+    def __contains__(self, person_id):
+        return person_id in self.rows
+
+    def __iter__(self):
+        return iter(self.person_ids)
+
+    def __len__(self):
+        return len(self.person_ids)
+
+    @property
+    def matrix(self):
+        return self._matrix[:len(self.person_ids), :len(self.columns)]
+
+    def _reserve(self, num_rows, num_columns):
+        capacity_rows, capacity_columns = self._matrix.shape
+        if num_rows <= capacity_rows and num_columns <= capacity_columns:
+            return
+        if num_rows > capacity_rows:
+            capacity_rows = max(num_rows, 2 * capacity_rows)
+        if num_columns > capacity_columns:
+            capacity_columns = max(num_columns, 2 * capacity_columns)
+        matrix = numpy.zeros((capacity_rows, capacity_columns), dtype=numpy.uint8)
+        old_rows, old_columns = self._matrix.shape
+        matrix[:old_rows, :old_columns] = self._matrix
+        self._matrix = matrix
+
+    def reset_markers(self):
+        #forget every marker and call, but keep the people and the genotype codes
+        self.columns = {}
+        self.layouts = []
+        self._matrix = numpy.zeros((len(self.person_ids), 0), dtype=numpy.uint8)
+
+    def add_person(self, person_id):
+        if person_id not in self.rows:
+            self._reserve(len(self.person_ids) + 1, len(self.columns))
+            self.rows[person_id] = len(self.person_ids)
+            self.person_ids.append(person_id)
+        return self.rows[person_id]
+
+    def add_marker(self, rsid):
+        if rsid not in self.columns:
+            self.columns[rsid] = len(self.columns)
+        return self.columns[rsid]
+
+    def find_layout(self, rsids, chromosomes):
+        #the columns of a list of markers that was added before, or None
+        for layout_rsids, layout_chromosomes, columns in self.layouts:
+            if numpy.array_equal(layout_rsids, rsids) and numpy.array_equal(layout_chromosomes, chromosomes):
+                return columns
+        return None
+
+    def add_layout(self, rsids, chromosomes, columns, max_layouts=8):
+        self.layouts = self.layouts[-(max_layouts - 1):] + [(rsids, chromosomes, columns)]
+
+    def code(self, bases):
+        try:
+            return self.codes[bases]
+        except KeyError:
+            if len(self.genotypes) > numpy.iinfo(numpy.uint8).max:
+                raise ValueError('Too many distinct genotypes: ' + str(bases))
+            self.codes[bases] = len(self.genotypes)
+            self.genotypes.append(bases)
+            return self.codes[bases]
+
+    def set_calls(self, person_id, columns, codes):
+        row = self.add_person(person_id)
+        self._reserve(len(self.person_ids), len(self.columns))
+        self._matrix[row][numpy.asarray(columns, dtype=numpy.intp)] = numpy.asarray(codes, dtype=numpy.uint8)
+
+    def fill(self, person_id, code):
+        row = self.add_person(person_id)
+        self._reserve(len(self.person_ids), len(self.columns))
+        self._matrix[row][:len(self.columns)] = code
+
+    def calls(self, person_id, columns):
+        return self._matrix[self.rows[person_id]][numpy.asarray(columns, dtype=numpy.intp)]
@@ -0,0 +1,130 @@
+import json
+import numpy
+import os
+from threading import get_ident
+
+CHROMOSOMES = list(map(str, range(1, 23))) + ['X']
+
+CACHE_VERSION = 1
+
+def map_filename(hapmap_dir, chromosome):
+    return hapmap_dir + '/genetic_map_GRCh37_chr' + chromosome + '.txt'
+
+def cache_dir_of(hapmap_dir):
+    return hapmap_dir.rstrip('/') + '.cache'
+
+def parse_hap_map(hapmap_dir):
+    hap_map = {}
+
+    for chromosome in CHROMOSOMES:
+        bp_positions = [0]
+        cm_positions = [0.0]
+        try:
+            for line in open(map_filename(hapmap_dir, chromosome)):
+                if line.startswith('Chromosome'):
+                    continue
+
+                cells = line.split('\t')
+                bp_positions.append(int(cells[1]))
+                cm_positions.append(float(cells[3]))
+        except FileNotFoundError:
+            continue
+
+        bp_positions = numpy.array(bp_positions, dtype=numpy.int64)
+        cm_positions = numpy.array(cm_positions, dtype=numpy.float64)
+        order = numpy.argsort(bp_positions, kind='stable')
+        hap_map[chromosome] = (bp_positions[order], cm_positions[order])
+
+    return hap_map
+
+def source_stats(hapmap_dir):
+    stats = {}
+    for chromosome in CHROMOSOMES:
+        try:
+            stat = os.stat(map_filename(hapmap_dir, chromosome))
+            stats[chromosome] = [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            stats[chromosome] = None
+    return stats
+
+def read_cache(cache_dir, stats):
+    try:
+        with open(cache_dir + '/manifest.json') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if manifest != {'version': CACHE_VERSION, 'sources': stats}:
+        return None
+
+    hap_map = {}
+    try:
+        for chromosome in CHROMOSOMES:
+            if stats[chromosome] is None:
+                continue
+            hap_map[chromosome] = (
+                numpy.load(cache_dir + '/chr' + chromosome + '.bp.npy', mmap_mode='r'),
+                numpy.load(cache_dir + '/chr' + chromosome + '.cm.npy', mmap_mode='r'),
+            )
+    except (OSError, ValueError):
+        return None
+    return hap_map
+
+def save_array(filename, array):
+    #replace the file instead of overwriting it, so that processes that have the old file mapped can still read it
+    temp_filename = filename + '.' + str(os.getpid()) + '.' + str(get_ident()) + '.tmp'
+    with open(temp_filename, 'wb') as array_file:
+        numpy.save(array_file, array)
+    os.replace(temp_filename, filename)
+
+def write_cache(cache_dir, stats, hap_map):
+    os.makedirs(cache_dir, exist_ok=True)
+    #the manifest is written last, so a half-written cache is never used
+    if os.path.exists(cache_dir + '/manifest.json'):
+        os.remove(cache_dir + '/manifest.json')
+    for chromosome, (bp_positions, cm_positions) in hap_map.items():
+        save_array(cache_dir + '/chr' + chromosome + '.bp.npy', bp_positions)
+        save_array(cache_dir + '/chr' + chromosome + '.cm.npy', cm_positions)
+    with open(cache_dir + '/manifest.json', 'w') as manifest_file:
+        json.dump({'version': CACHE_VERSION, 'sources': stats}, manifest_file)
+
+def load_hap_map(hapmap_dir):
+    '''
+    Load the HapMap genetic maps into a dict of chromosome to a pair of sorted
+    arrays: base pair positions and the matching centimorgan positions. Each
+    map starts at (0, 0). Chromosomes without a map file are left out.
+
+    The parsed maps are cached as memory-mapped .npy files in a directory next
+    to hapmap_dir, and the cache is rebuilt whenever the size or modification
+    time of any map file changes.
+    '''
+    stats = source_stats(hapmap_dir)
+    if all(stat is None for stat in stats.values()):
+        return {}
+
+    cache_dir = cache_dir_of(hapmap_dir)
+    hap_map = read_cache(cache_dir, stats)
+    if hap_map is not None:
+        return hap_map
+
+    hap_map = parse_hap_map(hapmap_dir)
+    try:
+        write_cache(cache_dir, stats, hap_map)
+    except OSError:
+        pass
+    return hap_map
+
+def interpolate(hap_map, chromosome, bp_positions):
+    '''
+    Return the centimorgan positions of an array of base pair positions on one
+    chromosome, interpolating linearly between the two surrounding map points
+    and extrapolating from the last two points past the end of the map.
+    '''
+    map_bp_positions, map_cm_positions = hap_map[chromosome]
+    bp_positions = numpy.asarray(bp_positions, dtype=numpy.int64)
+    low = numpy.searchsorted(map_bp_positions, bp_positions, side='right') - 1
+    low = numpy.clip(low, 0, len(map_bp_positions) - 2)
+    high = low + 1
+    return (
+        map_cm_positions[low] + (map_cm_positions[high] - map_cm_positions[low]) *
+        (bp_positions - map_bp_positions[low]) / (map_bp_positions[high] - map_bp_positions[low])
+    )
@@ -0,0 +1,14 @@
+from multiprocessing import get_context
+
+def map_jobs(function, items, jobs=1):
+    '''
+    Yield function(item) for each of items, in the order of items, running
+    them in a pool of jobs worker processes if jobs is more than 1. The workers
+    are forked, so they see the module state that the caller set up before the
+    call and do not re-run the calling script.
+    '''
+    if jobs > 1:
+        with get_context('fork').Pool(jobs) as pool:
+            yield from pool.imap(function, items)
+    else:
+        yield from map(function, items)
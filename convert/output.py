@@ -0,0 +1,103 @@
+import numpy
+from os.path import basename
+from time import perf_counter
+
+from genotypes import NO_CALL
+
+class OutputFile:
+    '''
+    A binary output file with a large write buffer that counts the bytes written
+    to it and reports its throughput when it is closed.
+    '''
+
+    def __init__(self, filename, buffer_size=1 << 22):
+        self.filename = filename
+        self.file = open(filename, 'wb', buffering=buffer_size)
+        self.bytes_written = 0
+        self.start_time = perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.file.write(data)
+        self.bytes_written += memoryview(data).nbytes
+
+    def write_lines(self, lines, block_size=65536):
+        block = []
+        for line in lines:
+            block.append(line)
+            if len(block) == block_size:
+                self.write(''.join(block))
+                block = []
+        self.write(''.join(block))
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        elapsed = perf_counter() - self.start_time
+        rate = self.bytes_written / elapsed if elapsed > 0 else 0
+        print(
+            'Wrote ' + basename(self.filename) + ': ' + str(self.bytes_written) + ' bytes in ' +
+            '%.2f' % elapsed + ' s (' + '%.1f' % (rate / 1e6) + ' MB/s)'
+        )
+
+def piece_rows(pieces, row):
+    #the genotype codes of one person in each piece, or no calls if the person is not in it
+    for rsids, matrix, columns in pieces:
+        if row < len(matrix):
+            yield matrix[row][columns]
+        else:
+            yield numpy.full(len(columns), NO_CALL, dtype=numpy.uint8)
+
+def write_ped(filename, pedigree, genotypes, pieces):
+    '''
+    Write a PED file, one row per person in pedigree. pieces is a list of
+    (rsids, matrix, columns) tuples: the rows of each matrix are people in
+    pedigree order and its columns (selected by columns) are the markers in
+    rsids. The rows are streamed, so the whole PED is never held in memory.
+    '''
+    cells = [('\t' + bases[0] + ' ' + bases[1]).encode() for bases in genotypes]
+    cell_width = len(cells[0])
+    uniform = all(len(cell) == cell_width for cell in cells)
+    if uniform:
+        #build each row in a preallocated buffer with one lookup per marker
+        cell_table = numpy.frombuffer(b''.join(cells), dtype=numpy.uint8).reshape(-1, cell_width)
+        row_buffer = numpy.empty((max([len(columns) for rsids, matrix, columns in pieces] + [0]), cell_width), dtype=numpy.uint8)
+
+    with OutputFile(filename) as ped_file:
+        for row, fields in enumerate(pedigree):
+            ped_file.write('\t'.join(fields))
+            for codes in piece_rows(pieces, row):
+                if uniform:
+                    numpy.take(cell_table, codes, axis=0, out=row_buffer[:len(codes)])
+                    ped_file.write(row_buffer[:len(codes)])
+                else:
+                    ped_file.write(b''.join([cells[code] for code in codes.tolist()]))
+            ped_file.write(b'\n')
+
+def write_map_files(path, snp_map):
+    #the PLINK MAP, MERLIN MAP and MERLIN DAT files
+    with OutputFile(path + '.plink.map') as plink_map_file:
+        plink_map_file.write('# chromosome\trsid\tmorgans\tposition\n')
+        plink_map_file.write_lines(
+            snp_map[rsid][0] + '\t' + rsid + '\t' + str(snp_map[rsid][2] / 100) + '\t' + str(snp_map[rsid][1]) + '\n'
+            for rsid in snp_map
+        )
+
+    with OutputFile(path + '.merlin.map') as merlin_map_file:
+        merlin_map_file.write('CHROMOSOME\tMARKER_NAME\tPOSITION\n')
+        merlin_map_file.write_lines(
+            snp_map[rsid][0] + '\t' + rsid + '\t' + str(snp_map[rsid][2]) + '\n'
+            for rsid in snp_map
+        )
+
+    with OutputFile(path + '.merlin.dat') as merlin_dat_file:
+        merlin_dat_file.write('A  affection\n')
+        merlin_dat_file.write_lines('M  ' + rsid + '\n' for rsid in snp_map)
@@ -0,0 +1,88 @@
+import numpy
+
+from genotypes import ABSENT
+from genotypes import NO_CALL
+from output import OutputFile
+
+BED_MAGIC = bytes([0x6c, 0x1b, 0x01]) #SNP-major
+
+HOMOZYGOUS_A1 = 0b00
+MISSING = 0b01
+HETEROZYGOUS = 0b10
+HOMOZYGOUS_A2 = 0b11
+
+def allele_tables(genotypes):
+    #for each base, how many copies of it each genotype code has
+    bases = sorted(set(base for bases in genotypes for base in bases) - {'0'})
+    while len(bases) < 2:
+        bases.append('0') #never counted, so never chosen
+    tables = numpy.zeros((len(bases), len(genotypes)), dtype=numpy.uint8)
+    for code in range(ABSENT + 1, len(genotypes)):
+        for base in genotypes[code]:
+            if base != '0':
+                tables[bases.index(base)][code] += 1
+    return bases, tables
+
+def encode_block(matrix, bases, tables):
+    '''
+    Return the two alleles of each marker in a people x markers block of
+    genotype codes, and the block packed as PLINK .bed rows. The most common
+    allele is A2 and the second most common is A1; calls with any other allele
+    are written as missing.
+    '''
+    num_people, num_markers = matrix.shape
+    counts = numpy.stack([table[matrix] for table in tables]) #bases x people x markers
+    totals = counts.sum(axis=1, dtype=numpy.int64)
+    order = numpy.argsort(-totals, axis=0, kind='stable')
+    a2 = order[0]
+    a1 = order[1]
+    markers = numpy.arange(num_markers)
+    a2_present = totals[a2, markers] > 0
+    a1_present = totals[a1, markers] > 0
+
+    a1_counts = counts[a1, :, markers].T
+    a2_counts = counts[a2, :, markers].T
+    values = numpy.full(matrix.shape, MISSING, dtype=numpy.uint8)
+    called = a1_counts + a2_counts == 2
+    values[called & (a1_counts == 2)] = HOMOZYGOUS_A1
+    values[called & (a1_counts == 1)] = HETEROZYGOUS
+    values[called & (a2_counts == 2)] = HOMOZYGOUS_A2
+
+    #pack four people per byte, first person in the lowest bits
+    padded = numpy.zeros((num_markers, -(-num_people // 4) * 4), dtype=numpy.uint8)
+    padded[:, :num_people] = values.T
+    padded = padded.reshape(num_markers, -1, 4)
+    packed = padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+
+    allele1 = [bases[a] if present else '0' for a, present in zip(a1.tolist(), a1_present.tolist())]
+    allele2 = [bases[a] if present else '0' for a, present in zip(a2.tolist(), a2_present.tolist())]
+    return allele1, allele2, packed.tobytes()
+
+def write_bed(path, pedigree, genotypes, snp_map, pieces, block_size=16384):
+    '''
+    Write PLINK binary .bed, .bim and .fam files. pedigree holds the family ID,
+    person ID, father ID, mother ID, sex and affection of each person. pieces is
+    a list of (rsids, matrix, columns) tuples: the rows of each matrix are people
+    in pedigree order and its columns (selected by columns) are the markers in
+    rsids, whose positions are in snp_map. People past the end of a matrix have
+    no calls in it.
+    '''
+    with OutputFile(path + '.fam') as fam_file:
+        fam_file.write_lines('\t'.join(fields) + '\n' for fields in pedigree)
+
+    bases, tables = allele_tables(genotypes)
+
+    with OutputFile(path + '.bed') as bed_file, OutputFile(path + '.bim') as bim_file:
+        bed_file.write(BED_MAGIC)
+        for rsids, matrix, columns in pieces:
+            for start in range(0, len(rsids), block_size):
+                end = min(start + block_size, len(rsids))
+                block = numpy.full((len(pedigree), end - start), NO_CALL, dtype=numpy.uint8)
+                block[:len(matrix)] = matrix[:, columns[start:end]]
+                allele1, allele2, packed = encode_block(block, bases, tables)
+                bed_file.write(packed)
+                bim_file.write(''.join(
+                    snp_map[rsid][0] + '\t' + rsid + '\t' + str(snp_map[rsid][2] / 100) + '\t' +
+                    str(snp_map[rsid][1]) + '\t' + allele1[i] + '\t' + allele2[i] + '\n'
+                    for i, rsid in enumerate(rsids[start:end])
+                ))
@@ -0,0 +1,136 @@
+import cProfile
+import io
+import json
+import pstats
+import resource
+import sys
+from collections import Counter
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter
+
+PROFILE_VERSION = 1
+
+def timed(function, argument):
+    #the result of function(argument) and how long it took, measured wherever it runs
+    start = perf_counter()
+    result = function(argument)
+    return result, perf_counter() - start
+
+def cpu_time():
+    #this process and its finished child processes, such as the workers of a pool that has been closed
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime
+
+def peak_rss():
+    #the high-water marks of this process and of its largest finished child process, in bytes
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    )
+
+class Profiler:
+    '''
+    Record the wall time, CPU time, peak memory and item counts of each phase
+    of a program, and the ingestion rate of each input file. The peak memory
+    of a phase is the high-water mark of the process when the phase ends, so a
+    phase that raised the high-water mark is the phase that used the most
+    memory so far. One phase may also be run under cProfile.
+    '''
+
+    def __init__(self, cprofile_phase=None):
+        self.phases = OrderedDict()
+        self.files = OrderedDict()
+        self.cprofile_phase = cprofile_phase
+        self.cprofile = None
+        self.start_wall = perf_counter()
+        self.start_cpu = cpu_time()
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Time the body of a with statement as the phase name, adding to the
+        totals of the phase if it has run before, and yield a Counter of the
+        items that the phase handled.
+        '''
+        if name not in self.phases:
+            self.phases[name] = {
+                'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0, 'peak_rss_children': 0, 'peak_rss_growth': 0, 'counts': Counter(),
+            }
+        record = self.phases[name]
+        start_wall = perf_counter()
+        start_cpu = cpu_time()
+        start_rss = peak_rss()[0]
+        if name == self.cprofile_phase:
+            if self.cprofile is None:
+                self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        try:
+            yield record['counts']
+        finally:
+            if name == self.cprofile_phase:
+                self.cprofile.disable()
+            record['wall'] += perf_counter() - start_wall
+            record['cpu'] += cpu_time() - start_cpu
+            record['peak_rss'], record['peak_rss_children'] = peak_rss()
+            record['peak_rss_growth'] += record['peak_rss'] - start_rss
+
+    def add_file(self, filename, size, lines, seconds):
+        #a file read in several passes adds up
+        if filename not in self.files:
+            self.files[filename] = {'bytes': size, 'lines': 0, 'seconds': 0.0}
+        self.files[filename]['lines'] += lines
+        self.files[filename]['seconds'] += seconds
+
+    def report(self, program):
+        files = []
+        for filename, record in self.files.items():
+            seconds = record['seconds']
+            files.append(OrderedDict([
+                ('filename', filename),
+                ('bytes', record['bytes']),
+                ('lines', record['lines']),
+                ('seconds', seconds),
+                ('lines_per_second', record['lines'] / seconds if seconds > 0 else None),
+                ('megabytes_per_second', record['bytes'] / 1e6 / seconds if seconds > 0 else None),
+            ]))
+        report = OrderedDict([
+            ('version', PROFILE_VERSION),
+            ('program', program),
+            ('arguments', sys.argv[1:]),
+            ('wall', perf_counter() - self.start_wall),
+            ('cpu', cpu_time() - self.start_cpu),
+            ('peak_rss', peak_rss()[0]),
+            ('phases', self.phases),
+            ('files', files),
+        ])
+        if self.cprofile is not None:
+            report['cprofile'] = OrderedDict([('phase', self.cprofile_phase), ('functions', self.top_functions())])
+        return report
+
+    def top_functions(self, count=25):
+        #the functions with the most cumulative time in the profiled phase
+        stats = pstats.Stats(self.cprofile, stream=io.StringIO())
+        functions = []
+        for (filename, line, function_name), (primitive_calls, calls, total_time, cumulative_time, callers) in stats.stats.items():
+            functions.append(OrderedDict([
+                ('function', filename + ':' + str(line) + '(' + function_name + ')'),
+                ('calls', calls),
+                ('total', total_time),
+                ('cumulative', cumulative_time),
+            ]))
+        functions.sort(key=lambda function: function['cumulative'], reverse=True)
+        return functions[:count]
+
+    def write(self, filename, program):
+        '''
+        Write the JSON report to filename and, if a phase was profiled, its
+        cProfile statistics to filename + '.prof' for pstats or other viewers.
+        '''
+        with open(filename, 'w') as report_file:
+            json.dump(self.report(program), report_file, indent=4)
+            report_file.write('\n')
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(filename + '.prof')
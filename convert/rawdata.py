@@ -0,0 +1,432 @@
+import bz2
+import csv
+import gzip
+import hashlib
+import mmap
+import numpy
+import os
+from collections import OrderedDict
+from numpy.lib.stride_tricks import sliding_window_view
+from queue import Queue
+from threading import Event
+from threading import Thread
+from zipfile import BadZipFile
+from zipfile import ZipFile
+
+CACHE_VERSION = 2
+
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+HASH = ord('#')
+QUOTE = ord('"')
+
+rows_to_ignore = [
+    ['rsid', 'chromosome', 'position', 'allele1', 'allele2'], #Ancestry.com
+    ['Name', 'Variation', 'Chromosome', 'Position', 'Strand', 'YourCode'], #deCODEme
+    ['RSID', 'CHROMOSOME', 'POSITION', 'RESULT'], #FTDNA
+]
+
+#the columns of the rsid, chromosome, position and genotype (or alleles) after each header
+LAYOUT_23ANDME = (0, 1, 2, (3,))
+LAYOUTS = {
+    0: (0, 1, 2, (3, 4)), #Ancestry.com
+    1: (0, 2, 3, (5,)), #deCODEme
+    2: (0, 1, 2, (3,)), #FTDNA
+}
+
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.zip')
+
+def is_compressed(filename):
+    return filename.endswith(COMPRESSED_EXTENSIONS)
+
+def strip_compression(filename):
+    #the name of a .gz or .bz2 file without that extension
+    for extension in COMPRESSED_EXTENSIONS:
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+    return filename
+
+def open_raw_file(filename):
+    '''
+    Open a raw data file for reading as binary, decompressing .gz, .bz2 and
+    .zip files as they are read, and return it along with the name of the data
+    in it. The data in a .zip file is its largest member.
+    '''
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb'), filename[:-len('.gz')]
+    elif filename.endswith('.bz2'):
+        return bz2.open(filename, 'rb'), filename[:-len('.bz2')]
+    elif filename.endswith('.zip'):
+        #the open member keeps the archive's file open until the member itself is closed
+        with ZipFile(filename) as archive:
+            members = [info for info in archive.infolist() if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+            if len(members) == 0:
+                raise ValueError(filename + ' is empty')
+            member = max(members, key=lambda info: info.file_size)
+            return archive.open(member), member.filename
+    else:
+        return open(filename, 'rb'), filename
+
+def delimiter_of(filename):
+    if filename.endswith('.csv'):
+        return ','
+    else:
+        return '\t'
+
+def map_file(filename):
+    #the whole file as a read-only buffer, without reading it into memory
+    with open(filename, 'rb') as raw_file:
+        if os.fstat(raw_file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_blocks(raw_file, block_size=1 << 22, queue_size=4):
+    '''
+    Yield the contents of a file object in blocks of whole lines. The blocks
+    are read in a background thread, so reading and decompressing the next
+    blocks overlaps whatever the caller does with this one.
+    '''
+    blocks = Queue(queue_size)
+    stop = Event()
+
+    def read():
+        try:
+            with raw_file:
+                while not stop.is_set():
+                    block = raw_file.read(block_size)
+                    blocks.put(block)
+                    if not block:
+                        break
+        except Exception as error:
+            blocks.put(error)
+
+    Thread(target=read, daemon=True).start()
+    partial_line = b''
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                break
+            last_newline = block.rfind(b'\n')
+            if last_newline == -1:
+                partial_line += block
+                continue
+            yield partial_line + block[:last_newline + 1]
+            partial_line = block[last_newline + 1:]
+        if partial_line:
+            yield partial_line
+    finally:
+        #let the reader finish if the caller stops early
+        stop.set()
+        while not blocks.empty():
+            blocks.get()
+
+def read_file(filename):
+    #the whole uncompressed contents of a raw data file as a read-only buffer
+    if is_compressed(filename):
+        raw_file, data_name = open_raw_file(filename)
+        return b''.join(read_blocks(raw_file))
+    return map_file(filename)
+
+def find_lines(data):
+    #the start and end offsets of every line that is not blank or a comment
+    newlines = numpy.flatnonzero(data == NEWLINE)
+    starts = numpy.concatenate(([0], newlines + 1))
+    ends = numpy.concatenate((newlines, [len(data)]))
+    nonblank = ends > starts
+    starts = starts[nonblank]
+    ends = ends[nonblank]
+    ends = ends - (data[ends - 1] == CARRIAGE_RETURN)
+    nonblank = ends > starts
+    starts = starts[nonblank]
+    ends = ends[nonblank]
+    data_lines = data[starts] != HASH
+    return starts[data_lines], ends[data_lines]
+
+def find_fields(data, starts, ends, delimiter, count):
+    #the start and end offsets of the first count fields of every line, empty past the end of the line
+    delimiters = numpy.flatnonzero(data == ord(delimiter))
+    index = numpy.searchsorted(delimiters, starts)
+    fields = []
+    field_starts = starts
+    for i in range(0, count):
+        if len(delimiters) > 0:
+            field_ends = delimiters[numpy.minimum(index, len(delimiters) - 1)]
+            field_ends = numpy.where((index < len(delimiters)) & (field_ends < ends), field_ends, ends)
+        else:
+            field_ends = ends
+        fields.append((field_starts, field_ends))
+        field_starts = numpy.minimum(field_ends + 1, ends)
+        index = index + 1
+    return fields
+
+def parse_integers(data, field):
+    #the decimal number in one field of every line
+    starts, ends = field
+    lengths = ends - starts
+    numbers = numpy.zeros(len(starts), dtype=numpy.int64)
+    if len(starts) == 0:
+        return numbers
+    if lengths.min() < 1 or lengths.max() > 18:
+        raise ValueError('Invalid position')
+    for i in range(0, int(lengths.max())):
+        has_digit = i < lengths
+        digits = data[numpy.where(has_digit, ends - 1 - i, 0)].astype(numpy.int64) - ord('0')
+        if numpy.any(has_digit & ((digits < 0) | (digits > 9))):
+            raise ValueError('Invalid position')
+        numbers += numpy.where(has_digit, digits * 10 ** i, 0)
+    return numbers
+
+def gather(data, field, unquote=False):
+    #copy one field of every line into a fixed-width bytes array
+    starts, ends = field
+    if unquote and len(starts) > 0:
+        quoted = (ends - starts >= 2) & (data[starts] == QUOTE) & (data[numpy.maximum(ends - 1, 0)] == QUOTE)
+        starts = starts + quoted
+        ends = ends - quoted
+    lengths = ends - starts
+    width = max(int(lengths.max()) if len(lengths) > 0 else 0, 1)
+    chars = numpy.zeros((len(starts), width), dtype=numpy.uint8)
+    if len(data) >= width:
+        #copy width bytes from the start of each field, then blank out what follows the field
+        windows = sliding_window_view(data, width)
+        in_range = starts < len(windows)
+        chars[in_range] = windows[starts[in_range]]
+        for i in numpy.flatnonzero(~in_range).tolist():
+            chars[i][:lengths[i]] = data[starts[i]:ends[i]]
+        chars[numpy.arange(width) >= lengths[:, None]] = 0
+    else:
+        for i in range(0, len(starts)):
+            chars[i][:lengths[i]] = data[starts[i]:ends[i]]
+    return chars.view('S' + str(width)).ravel()
+
+def starts_with(data, starts, ends, prefix):
+    #the indexes of the lines that start with prefix, narrowed down one byte at a time
+    indexes = numpy.flatnonzero(ends - starts >= len(prefix))
+    for i, byte in enumerate(prefix):
+        indexes = indexes[data[starts[indexes] + i] == byte]
+    return indexes
+
+def find_headers(data, starts, ends, delimiter):
+    '''
+    Return a mask of the header lines listed in rows_to_ignore, and the index in
+    rows_to_ignore of the last header found, or None if there were none.
+    '''
+    headers = numpy.zeros(len(starts), dtype=bool)
+    header_type = None
+    if len(starts) == 0:
+        return headers, header_type
+    candidates = set()
+    for row in rows_to_ignore:
+        candidates.update(starts_with(data, starts, ends, (row[0] + delimiter).encode()).tolist())
+        candidates.update(starts_with(data, starts, ends, ('"' + row[0] + '"' + delimiter).encode()).tolist())
+    for line_index in sorted(candidates):
+        line = bytes(data[starts[line_index]:ends[line_index]]).decode()
+        row = next(csv.reader([line], delimiter=delimiter))
+        if row in rows_to_ignore:
+            headers[line_index] = True
+            header_type = rows_to_ignore.index(row)
+    return headers, header_type
+
+def read_rsids(filename):
+    '''
+    Return the rsids of every marker in a raw data file as an array of bytes,
+    in file order, skipping comments and the headers in rows_to_ignore.
+    Compressed files are parsed one block at a time as they are decompressed.
+    '''
+    if is_compressed(filename):
+        raw_file, data_name = open_raw_file(filename)
+        buffers = read_blocks(raw_file)
+    else:
+        data_name = filename
+        buffers = [map_file(filename)]
+
+    delimiter = delimiter_of(data_name)
+    rsids = [numpy.array([], dtype='S1')]
+    for buffer in buffers:
+        data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        starts, ends = find_lines(data)
+        headers, header_type = find_headers(data, starts, ends, delimiter)
+        starts = starts[~headers]
+        ends = ends[~headers]
+        rsids.append(gather(data, find_fields(data, starts, ends, delimiter, 1)[0], unquote=True))
+    return numpy.concatenate(rsids)
+
+def read_columns(buffer, delimiter, header_type=None):
+    '''
+    Split a raw data file in a buffer into arrays of rsids, chromosomes, base
+    pair positions and genotypes, with one element per marker, and return them
+    along with the start and end offsets of each marker's line and the type of
+    the last header found. No Python objects are created per line. header_type
+    is the type of the header before the buffer, if the buffer is part of a
+    larger file.
+    '''
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    starts, ends = find_lines(data)
+    headers, found_header_type = find_headers(data, starts, ends, delimiter)
+    if found_header_type is not None:
+        header_type = found_header_type
+    starts = starts[~headers]
+    ends = ends[~headers]
+
+    rsid_column, chromosome_column, position_column, genotype_columns = LAYOUTS.get(header_type, LAYOUT_23ANDME)
+    fields = find_fields(data, starts, ends, delimiter, max(genotype_columns) + 1)
+    unquote = delimiter == ','
+    rsids = gather(data, fields[rsid_column], unquote)
+    chromosomes = gather(data, fields[chromosome_column], unquote)
+    position_starts, position_ends = fields[position_column]
+    if unquote:
+        quoted = (position_ends - position_starts >= 2) & (data[position_starts] == QUOTE)
+        position_starts = position_starts + quoted
+        position_ends = position_ends - quoted
+    bp_positions = parse_integers(data, (position_starts, position_ends))
+    if len(genotype_columns) == 1:
+        genotypes = gather(data, fields[genotype_columns[0]], unquote)
+    else:
+        #one allele per column, so keep the first character of each
+        alleles = [gather(data, fields[column], unquote).astype('S1').view(numpy.uint8) for column in genotype_columns]
+        genotypes = numpy.stack(alleles, axis=1).view('S' + str(len(alleles))).ravel()
+    return rsids, chromosomes, bp_positions, genotypes, starts, ends, header_type
+
+def normalize(genotype):
+    genotype = genotype.decode()
+    if genotype == '':
+        return ('0', '0')
+    base1 = genotype[0].replace('-', '0')
+    if len(genotype) > 1:
+        base2 = genotype[1].replace('-', '0')
+    else: #X, Y, MT
+        base2 = base1
+    if base1 == '0':
+        base2 = '0'
+    if base2 == '0':
+        base1 = '0'
+    return (base1, base2)
+
+def encode_genotypes(rsids, chromosomes, bp_positions, genotypes):
+    if genotypes.dtype.itemsize in (1, 2, 4, 8):
+        #sorting the genotypes as integers is much faster than as strings
+        keys = genotypes.view('u' + str(genotypes.dtype.itemsize))
+        distinct_keys, codes = numpy.unique(keys, return_inverse=True)
+        distinct_genotypes = distinct_keys.view(genotypes.dtype)
+    else:
+        distinct_genotypes, codes = numpy.unique(genotypes, return_inverse=True)
+    #the codes are stored in one byte each
+    if len(distinct_genotypes) > numpy.iinfo(numpy.uint8).max + 1:
+        raise ValueError('Too many distinct genotypes: ' + str(len(distinct_genotypes)))
+    genotypes = [normalize(genotype) for genotype in distinct_genotypes.tolist()]
+    return rsids, chromosomes, bp_positions, genotypes, codes.astype(numpy.uint8).ravel()
+
+def parse_buffer(buffer, delimiter, header_type=None):
+    return encode_genotypes(*read_columns(buffer, delimiter, header_type)[:4])
+
+def parse_compressed_file(filename):
+    #parse each block of a compressed file as soon as it is decompressed
+    raw_file, data_name = open_raw_file(filename)
+    delimiter = delimiter_of(data_name)
+    columns = [[numpy.array([], dtype='S1')], [numpy.array([], dtype='S1')], [numpy.array([], dtype=numpy.int64)], [numpy.array([], dtype='S1')]]
+    header_type = None
+    for buffer in read_blocks(raw_file):
+        rsids, chromosomes, bp_positions, genotypes, starts, ends, header_type = read_columns(buffer, delimiter, header_type)
+        for column, values in zip(columns, (rsids, chromosomes, bp_positions, genotypes)):
+            column.append(values)
+    return encode_genotypes(*[numpy.concatenate(column) for column in columns])
+
+def parse_file(filename):
+    '''
+    Parse one raw data file into a compact result that is cheap to send between
+    processes: arrays of the rsids, chromosomes and base pair positions of its
+    markers in file order, a table of the distinct (base1, base2) genotypes in
+    the file, and an array with one code into that table per marker. The file
+    may be compressed with gzip, bzip2 or zip.
+    '''
+    if is_compressed(filename):
+        return parse_compressed_file(filename)
+    return parse_buffer(map_file(filename), delimiter_of(filename))
+
+def data_name_of(filename):
+    #the name of the data in a raw data file, which tells how it is delimited
+    if filename.endswith('.zip'):
+        raw_file, data_name = open_raw_file(filename)
+        raw_file.close()
+        return data_name
+    return strip_compression(filename)
+
+def index_file(filename):
+    '''
+    Return the chromosomes in a raw data file in the order that they first
+    appear, each with the list of (start, end) byte ranges that hold its lines,
+    and the type of the file's header, which the ranges do not include.
+    '''
+    rsids, chromosomes, bp_positions, genotypes, starts, ends, header_type = read_columns(
+        read_file(filename), delimiter_of(data_name_of(filename))
+    )
+    ranges = OrderedDict()
+    if len(chromosomes) == 0:
+        return ranges, header_type
+    run_starts = numpy.flatnonzero(numpy.concatenate(([True], chromosomes[1:] != chromosomes[:-1])))
+    run_ends = numpy.concatenate((run_starts[1:], [len(chromosomes)])) - 1
+    for run_start, run_end in zip(run_starts.tolist(), run_ends.tolist()):
+        chromosome = chromosomes[run_start].decode()
+        ranges.setdefault(chromosome, []).append((int(starts[run_start]), int(ends[run_end])))
+    return ranges, header_type
+
+def parse_file_ranges(filename_ranges_and_header_type):
+    #like parse_file, but only the lines in the given byte ranges of a file with a header of the given type
+    filename, ranges, header_type = filename_ranges_and_header_type
+    buffer = read_file(filename)
+    return parse_buffer(
+        b'\n'.join([buffer[start:end] for start, end in ranges]), delimiter_of(data_name_of(filename)), header_type
+    )
+
+def write_cached_file(cache_filename, parsed_file):
+    rsids, chromosomes, bp_positions, genotypes, codes = parsed_file
+    temp_filename = cache_filename + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_filename, 'wb') as cache_file:
+        numpy.savez(
+            cache_file,
+            version=numpy.array(CACHE_VERSION),
+            rsids=rsids,
+            chromosomes=chromosomes,
+            bp_positions=bp_positions,
+            genotypes=numpy.array([base1 + base2 for base1, base2 in genotypes], dtype='U2'),
+            codes=codes,
+        )
+    os.replace(temp_filename, cache_filename)
+
+def read_cached_file(cache_filename):
+    with numpy.load(cache_filename) as cached:
+        if int(cached['version']) != CACHE_VERSION:
+            return None
+        genotypes = [(genotype[0], genotype[1]) for genotype in cached['genotypes'].tolist()]
+        return cached['rsids'], cached['chromosomes'], cached['bp_positions'], genotypes, cached['codes']
+
+def parse_file_cached(filename, cache_dir):
+    '''
+    Like parse_file, but keep the result in cache_dir under the SHA-256 hash of
+    the file's contents and delimiter, and load it from there if the same file
+    was parsed before.
+    '''
+    #the same bytes are parsed differently in a .csv file than in a .txt file
+    digest = hashlib.sha256(delimiter_of(data_name_of(filename)).encode())
+    with open(filename, 'rb') as raw_file:
+        for chunk in iter(lambda: raw_file.read(1 << 20), b''):
+            digest.update(chunk)
+    cache_filename = cache_dir + '/' + digest.hexdigest() + '.npz'
+
+    try:
+        parsed_file = read_cached_file(cache_filename)
+        if parsed_file is not None:
+            return parsed_file
+    except (OSError, ValueError, KeyError, BadZipFile):
+        pass
+
+    parsed_file = parse_file(filename)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_cached_file(cache_filename, parsed_file)
+    except OSError:
+        pass
+    return parsed_file
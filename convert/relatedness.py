@@ -0,0 +1,69 @@
+import numpy
+
+from genotypes import ABSENT
+
+def match_tables(genotypes):
+    #half and full match lookup tables indexed by [code1 * size + code2]
+    size = len(genotypes)
+    half = numpy.zeros(size * size, dtype=bool)
+    full = numpy.zeros(size * size, dtype=bool)
+    for code1 in range(ABSENT + 1, size):
+        for code2 in range(ABSENT + 1, size):
+            bases1 = genotypes[code1]
+            bases2 = genotypes[code2]
+            half[code1 * size + code2] = bool(set(bases1) & set(bases2))
+            full[code1 * size + code2] = sorted(bases1) == sorted(bases2)
+    return size, half, full
+
+def match_totals(raw_data, snp_map, hap_map, chromosomes, block_size=64):
+    '''
+    Compare every pair of people in raw_data and return three square matrices:
+    the half matches, full matches and possible matches of each pair, in
+    centimorgans on chromosomes that have a genetic map and in markers on those
+    that do not.
+    '''
+    person_ids = list(raw_data)
+    num_people = len(person_ids)
+    half_matches = numpy.zeros((num_people, num_people))
+    full_matches = numpy.zeros((num_people, num_people))
+    possible_matches = numpy.zeros((num_people, num_people))
+
+    size, half_table, full_table = match_tables(raw_data.genotypes)
+
+    for chromosome in chromosomes:
+        rsids = [rsid for rsid in snp_map if snp_map[rsid][0] == chromosome]
+        if len(rsids) == 0:
+            continue
+        weighted = chromosome in hap_map
+        if weighted:
+            rsids.sort(key=lambda rsid: snp_map[rsid][2])
+        cm_pos = numpy.array([snp_map[rsid][2] for rsid in rsids], dtype=float)
+
+        #one row per person, one column per marker in position order
+        matrix = raw_data.matrix[:, [raw_data.columns[rsid] for rsid in rsids]]
+        present = matrix != ABSENT
+        pair_base = matrix.astype(numpy.intp) * size
+
+        for person1 in range(num_people - 1):
+            for start in range(person1 + 1, num_people, block_size):
+                end = min(start + block_size, num_people)
+                shared = present[person1] & present[start:end]
+                if weighted:
+                    #distance from each shared marker back to the previous shared marker
+                    last_cm_pos = numpy.maximum.accumulate(numpy.where(shared, cm_pos, 0), axis=1)
+                    previous_cm_pos = numpy.zeros_like(last_cm_pos)
+                    previous_cm_pos[:, 1:] = last_cm_pos[:, :-1]
+                    dist_to_last = numpy.where(shared, cm_pos - previous_cm_pos, 0)
+                    possible = last_cm_pos[:, -1]
+                else:
+                    dist_to_last = shared.astype(float)
+                    possible = dist_to_last.sum(axis=1)
+                pairs = pair_base[person1] + matrix[start:end]
+                half_matches[person1, start:end] += (dist_to_last * half_table[pairs]).sum(axis=1)
+                full_matches[person1, start:end] += (dist_to_last * full_table[pairs]).sum(axis=1)
+                possible_matches[person1, start:end] += possible
+
+    half_matches += half_matches.T
+    full_matches += full_matches.T
+    possible_matches += possible_matches.T
+    return person_ids, half_matches, full_matches, possible_matches
@@ -0,0 +1,249 @@
+import json
+import os
+import signal
+import socket
+import socketserver
+from collections import OrderedDict
+from functools import partial
+from math import inf
+from os.path import realpath
+from threading import Lock
+from threading import Semaphore
+from time import perf_counter
+from converter import Converter
+from converter import list_files
+from converter import person_id_of
+from hapmap import load_hap_map
+from hapmap import source_stats
+from profiling import Profiler
+from rawdata import parse_file
+from rawdata import parse_file_cached
+
+def size_of(arrays):
+    return sum(array.nbytes for array in arrays if hasattr(array, 'nbytes'))
+
+def freeze(arrays):
+    #the cached arrays are shared by every job, so none of them may change them
+    for array in arrays:
+        if hasattr(array, 'setflags'):
+            array.setflags(write=False)
+    return arrays
+
+class ResidentCache:
+    '''
+    A least recently used cache of parsed HapMaps and raw data files that holds
+    at most max_bytes of arrays. Items are loaded at most once at a time: a job
+    that asks for an item that another job is loading waits for it instead of
+    loading it again. An evicted item stays in memory until the jobs that are
+    using it finish, so max_bytes can be exceeded while jobs are running.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.lock = Lock()
+        self.loading = {}
+
+    def get(self, key, load):
+        '''
+        Return the value of key and whether it was already loaded, calling
+        load() to load it if it was not. load returns the value and its size in
+        bytes.
+        '''
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key][0], True
+            key_lock = self.loading.setdefault(key, Lock())
+
+        with key_lock:
+            with self.lock:
+                if key in self.items:
+                    self.items.move_to_end(key)
+                    return self.items[key][0], True
+            value, size = load()
+            with self.lock:
+                self.loading.pop(key, None)
+                self.add(key, value, size)
+        return value, False
+
+    def add(self, key, value, size):
+        #an item that is bigger than the whole cache is used once and not kept
+        if size > self.max_bytes:
+            return
+        self.items[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            old_key, (old_value, old_size) = self.items.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'items': len(self.items), 'bytes': self.size, 'max_bytes': self.max_bytes, 'evictions': self.evictions}
+
+class ConversionService(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    A conversion server on a Unix socket. Each connection sends one job as a
+    line of JSON and gets one line of JSON back when the job is done. The
+    HapMaps and parsed raw data files of every job stay in a ResidentCache, so
+    a job that uses the same files as an earlier job does not read them again.
+    Up to max_jobs jobs run at once, but jobs that write the same output files
+    run one after another.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, socket_filename, max_bytes, max_jobs=1, cache_dir=None):
+        self.cache = ResidentCache(max_bytes)
+        self.slots = Semaphore(max_jobs)
+        self.cache_dir = cache_dir
+        self.output_locks = {}
+        self.lock = Lock()
+        self.job_count = 0
+        remove_stale_socket(socket_filename)
+        super().__init__(socket_filename, JobHandler)
+
+    def hap_map(self, hapmap_dir):
+        #the key changes whenever a map file changes, and the old HapMap is left to be evicted
+        hapmap_dir = realpath(hapmap_dir)
+        stats = source_stats(hapmap_dir)
+        key = ('hapmap', hapmap_dir, json.dumps(stats, sort_keys=True))
+
+        def load():
+            hap_map = load_hap_map(hapmap_dir)
+            return hap_map, sum(size_of(positions) for positions in hap_map.values())
+
+        return self.cache.get(key, load)
+
+    def parsed_file(self, filename, counts):
+        stat = os.stat(filename)
+        key = ('file', realpath(filename), stat.st_size, stat.st_mtime_ns)
+
+        def load():
+            if self.cache_dir:
+                parsed_file = parse_file_cached(filename, self.cache_dir)
+            else:
+                parsed_file = parse_file(filename)
+            return freeze(parsed_file), size_of(parsed_file)
+
+        parsed_file, hit = self.cache.get(key, load)
+        if hit:
+            counts['file_hits'] += 1
+        else:
+            counts['file_misses'] += 1
+        return parsed_file
+
+    def output_lock(self, out_dir, family_id):
+        with self.lock:
+            return self.output_locks.setdefault((realpath(out_dir), family_id), Lock())
+
+    def run_job(self, job):
+        '''
+        Convert the raw data files of a job, a dict of the options of
+        convert.py, and return the names of the output files, the time that the
+        job spent waiting and in each phase, and how much of it the cache held.
+        '''
+        received = perf_counter()
+        with self.lock:
+            self.job_count += 1
+            job_number = self.job_count
+
+        if 'files' in job:
+            files = [(filename, person_id_of(filename), affection) for filename, affection in job['files']]
+        else:
+            files = list_files([
+                (job.get('cases', 'cases'), '2'), (job.get('controls', 'controls'), '1'), (job.get('unknowns', 'unknowns'), '0'),
+            ], job.get('recursive', False))
+
+        end_pos = job.get('end')
+        profiler = Profiler()
+        counts = {'file_hits': 0, 'file_misses': 0}
+        evictions = self.cache.stats()['evictions']
+        family_id = job.get('family', 'FAM001')
+        out_dir = job.get('out', '.')
+
+        with self.slots, self.output_lock(out_dir, family_id):
+            started = perf_counter()
+            with profiler.phase('hapmap'):
+                hap_map, hapmap_hit = self.hap_map(job.get('hapmap', 'hapmap'))
+            converter = Converter(
+                hap_map, family_id, out_dir, job.get('parents', True), job.get('sexes', True), job.get('spacing', 0),
+                job.get('chr'), job.get('start', 0), inf if end_pos is None else end_pos, job.get('format', 'ped'),
+                profiler=profiler
+            )
+            converter.parse_file = partial(self.parsed_file, counts=counts)
+            converter.convert(files)
+
+        finished = perf_counter()
+        cache_stats = self.cache.stats()
+        print(
+            'Job ' + str(job_number) + ': ' + family_id + ', ' + str(len(files)) + ' files, ' +
+            str(counts['file_hits']) + ' cached, ' + str(round(finished - received, 3)) + ' s'
+        )
+        return OrderedDict([
+            ('ok', True),
+            ('job', job_number),
+            ('outputs', converter.output_filenames()),
+            ('latency', OrderedDict([
+                ('total', finished - received),
+                ('queued', started - received),
+                ('phases', OrderedDict((name, record['wall']) for name, record in profiler.phases.items())),
+            ])),
+            ('cache', OrderedDict([
+                ('hapmap_hit', hapmap_hit),
+                ('file_hits', counts['file_hits']),
+                ('file_misses', counts['file_misses']),
+                ('evictions', cache_stats['evictions'] - evictions),
+                ('resident_items', cache_stats['items']),
+                ('resident_bytes', cache_stats['bytes']),
+            ])),
+        ])
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            response = self.server.run_job(json.loads(self.rfile.readline()))
+        except Exception as error:
+            #a bad job must not stop the service
+            response = {'ok': False, 'error': type(error).__name__ + ': ' + str(error)}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+def remove_stale_socket(socket_filename):
+    #a socket file that nothing is listening on is left over from a service that did not shut down cleanly
+    if not os.path.exists(socket_filename):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_filename)
+        except ConnectionRefusedError:
+            os.remove(socket_filename)
+            return
+    raise OSError('A service is already listening on ' + socket_filename)
+
+def submit(socket_filename, job):
+    #send a job to a running service and return its response
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_filename)
+        client.sendall(json.dumps(job).encode() + b'\n')
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('rb') as response_file:
+            return json.loads(response_file.readline())
+
+def stop(signal_number, frame):
+    raise KeyboardInterrupt
+
+def serve(socket_filename, max_bytes, max_jobs=1, cache_dir=None):
+    #stop cleanly, removing the socket file, when stopped with Ctrl+C or by a service manager
+    signal.signal(signal.SIGTERM, stop)
+    service = ConversionService(socket_filename, max_bytes, max_jobs, cache_dir)
+    print('Listening on ' + socket_filename + '...')
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+        os.remove(socket_filename)
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+import os
+import sys
+from getopt import getopt
+from os.path import basename
+from os.path import dirname
+from os.path import join
+from os.path import realpath
+from os.path import splitext
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'convert'))
+
+from converter import Converter
+from converter import list_files
+from converter import person_id_of
+from hapmap import load_hap_map
+from ibd import find_segments
+from ibd import write_segments
+from rawdata import strip_compression
+
+proband_filename = None
+case_dir = 'cases'
+control_dir = 'controls'
+recursive = False
+out_dir = 'segments'
+min_cm = 7
+min_snps = 500
+jobs = 1
+cache_dir = None
+
+optlist, args = getopt(
+    sys.argv[1:], '-rj:',
+    ['proband=', 'cases=', 'controls=', 'recursive', 'out=', 'min-cm=', 'min-snps=', 'jobs=', 'cache=', 'help']
+)
+for name, value in optlist:
+    if name == '--proband':
+        proband_filename = value
+    elif name == '--cases':
+        case_dir = value
+    elif name == '--controls':
+        control_dir = value
+    elif name in ('-r', '--recursive'):
+        recursive = True
+    elif name == '--out':
+        out_dir = value
+    elif name == '--min-cm':
+        min_cm = float(value)
+    elif name == '--min-snps':
+        min_snps = int(value)
+    elif name in ('-j', '--jobs'):
+        jobs = int(value)
+    elif name == '--cache':
+        cache_dir = value
+    elif name == '--help':
+        print('Syntax: ./find-segments.py --proband=<file> [--cases=<dir>] [--controls=<dir>]')
+        print('                [-r | --recursive] [--out=<dir>] [--min-cm=<cm>] [--min-snps=<n>]')
+        print('                [-j <n> | --jobs=<n>] [--cache=<dir>]')
+        print('cases defaults to ./cases, controls defaults to ./controls, out defaults to')
+        print('./segments, min-cm defaults to 7, min-snps defaults to 500, and jobs defaults')
+        print('to 1.')
+        exit()
+
+if not proband_filename:
+    sys.stderr.write('--proband is required\n')
+    exit(1)
+
+def name_of(filename):
+    return splitext(basename(strip_compression(filename)))[0]
+
+print('Loading HapMap...')
+
+hap_map = load_hap_map('hapmap')
+
+print('Loading raw data files...')
+
+#the proband's own file may be in the cases or controls directory too
+relatives = [
+    (filename, person_id, affection)
+    for filename, person_id, affection in list_files([(case_dir, '2'), (control_dir, '1')], recursive)
+    if realpath(filename) != realpath(proband_filename)
+]
+proband_id = person_id_of(proband_filename)
+converter = Converter(hap_map, jobs=jobs, cache_dir=cache_dir)
+raw_data, snp_map = converter.parse([(proband_filename, proband_id, '0')] + relatives)
+
+print('Finding segments...')
+
+relative_ids = [person_id for filename, person_id, affection in relatives]
+segments_by_relative = find_segments(raw_data, snp_map, hap_map, proband_id, relative_ids, min_cm, min_snps, jobs)
+
+print('Writing files...')
+
+for group in ('cases', 'controls'):
+    os.makedirs(out_dir + '/' + group, exist_ok=True)
+for (filename, person_id, affection), segments in zip(relatives, segments_by_relative):
+    group = 'cases' if affection == '2' else 'controls'
+    write_segments(out_dir + '/' + group + '/' + name_of(filename) + '.csv', name_of(proband_filename), name_of(filename), segments)
+
+sys.stderr.write(
+    'Found ' + str(sum(len(segments) for segments in segments_by_relative)) + ' segments shared with ' +
+    str(sum(1 for segments in segments_by_relative if segments)) + ' of ' + str(len(relatives)) + ' relatives.\n'
+)
@@ -0,0 +1,135 @@
+import csv
+import numpy
+import os
+from genotypes import NO_CALL
+from jobs import map_jobs
+from relatedness import match_tables
+
+CHROMOSOMES = list(map(str, range(1, 23))) + ['X']
+
+HEADER = ['Comparison', 'Chromosome', 'Start Point', 'End Point', 'Genetic Distance', '#SNPs']
+
+def marker_positions(raw_data, snp_map, hap_map):
+    '''
+    Return the columns in raw_data of the markers of each chromosome sorted by
+    base pair position, with their base pair and centimorgan positions. Without
+    a genetic map of a chromosome, a megabase counts as a centimorgan.
+    '''
+    rsids_by_chromosome = {}
+    for rsid, (chromosome, bp_pos, cm_pos) in snp_map.items():
+        rsids_by_chromosome.setdefault(chromosome, []).append(rsid)
+
+    positions = {}
+    for chromosome in CHROMOSOMES:
+        if chromosome not in rsids_by_chromosome:
+            continue
+        rsids = sorted(rsids_by_chromosome[chromosome], key=lambda rsid: snp_map[rsid][1])
+        columns = numpy.array([raw_data.columns[rsid] for rsid in rsids], dtype=numpy.intp)
+        bp_positions = numpy.array([snp_map[rsid][1] for rsid in rsids], dtype=numpy.int64)
+        if chromosome in hap_map:
+            cm_positions = numpy.array([snp_map[rsid][2] for rsid in rsids], dtype=float)
+        else:
+            cm_positions = bp_positions / 1e6
+        positions[chromosome] = (columns, bp_positions, cm_positions)
+    return positions
+
+def find_runs(proband_calls, relative_calls, pair_table, size, bp_positions, cm_positions, min_cm, min_snps):
+    '''
+    Find the runs of half matches between the proband and each of a block of
+    relatives on one chromosome. A run ends at each marker where the two are
+    opposite homozygotes, and markers that either of them did not call neither
+    end a run nor count towards it. Return the relative, start point, end
+    point, length in centimorgans and number of markers of each run that is at
+    least min_cm long and has at least min_snps markers.
+    '''
+    num_relatives, num_markers = relative_calls.shape
+    called = (proband_calls > NO_CALL) & (relative_calls > NO_CALL)
+    opposite = called & ~pair_table[proband_calls.astype(numpy.intp) * size + relative_calls]
+
+    #every row starts and ends with a break, so consecutive breaks in a row enclose a run
+    breaks = numpy.ones((num_relatives, num_markers + 2), dtype=bool)
+    breaks[:, 1:-1] = opposite
+    rows, columns = numpy.nonzero(breaks)
+    same_row = rows[:-1] == rows[1:]
+    rows = rows[:-1][same_row]
+    first = columns[:-1][same_row] #the marker after the break
+    last = columns[1:][same_row] - 2 #the marker before the next break
+    nonempty = first <= last
+    rows, first, last = rows[nonempty], first[nonempty], last[nonempty]
+
+    called_before = numpy.zeros((num_relatives, num_markers + 1), dtype=numpy.int64)
+    numpy.cumsum(called, axis=1, out=called_before[:, 1:])
+    snps = called_before[rows, last + 1] - called_before[rows, first]
+
+    #the first and last called markers of each run
+    marker_indexes = numpy.arange(num_markers)
+    next_called = numpy.where(called, marker_indexes, num_markers)
+    next_called = numpy.minimum.accumulate(next_called[:, ::-1], axis=1)[:, ::-1]
+    previous_called = numpy.maximum.accumulate(numpy.where(called, marker_indexes, -1), axis=1)
+    has_calls = snps > 0
+    rows, first, last, snps = rows[has_calls], first[has_calls], last[has_calls], snps[has_calls]
+    first = next_called[rows, first]
+    last = previous_called[rows, last]
+
+    lengths = cm_positions[last] - cm_positions[first]
+    long_enough = (lengths >= min_cm) & (snps >= min_snps)
+    return (
+        rows[long_enough], bp_positions[first[long_enough]], bp_positions[last[long_enough]], lengths[long_enough],
+        snps[long_enough],
+    )
+
+#(raw_data, marker positions, proband_id, relative_ids, min_cm, min_snps) of the scan, inherited by forked workers
+scan_state = None
+
+def scan_chromosome(chromosome, block_size=64):
+    '''
+    Return the (relative, chromosome, start point, end point, centimorgans,
+    markers) of every run of half matches between the proband and a relative on
+    one chromosome, comparing a block of relatives with the proband at once.
+    '''
+    raw_data, positions, proband_id, relative_ids, min_cm, min_snps = scan_state
+    columns, bp_positions, cm_positions = positions[chromosome]
+    size, half_table, full_table = match_tables(raw_data.genotypes)
+    proband_calls = raw_data.calls(proband_id, columns)
+
+    segments = []
+    for start in range(0, len(relative_ids), block_size):
+        block = relative_ids[start:start + block_size]
+        relative_calls = raw_data.matrix[[raw_data.rows[relative_id] for relative_id in block]][:, columns]
+        for row, start_point, end_point, length, snps in zip(*[values.tolist() for values in find_runs(
+            proband_calls, relative_calls, half_table, size, bp_positions, cm_positions, min_cm, min_snps
+        )]):
+            segments.append((start + row, chromosome, start_point, end_point, length, snps))
+    return segments
+
+def find_segments(raw_data, snp_map, hap_map, proband_id, relative_ids, min_cm=7, min_snps=500, jobs=1):
+    '''
+    Compare the proband with each relative in relative_ids on every chromosome
+    and return a list of the segments of each relative, in the order of
+    relative_ids. raw_data, snp_map and hap_map are as loaded by
+    Converter.parse. The chromosomes are scanned in parallel if jobs is more
+    than 1.
+    '''
+    global scan_state
+    positions = marker_positions(raw_data, snp_map, hap_map)
+    scan_state = (raw_data, positions, proband_id, relative_ids, min_cm, min_snps)
+    results = list(map_jobs(scan_chromosome, positions, jobs))
+    scan_state = None
+
+    segments_by_relative = [[] for relative_id in relative_ids]
+    for chromosome_segments in results:
+        for relative, chromosome, start_point, end_point, length, snps in chromosome_segments:
+            segments_by_relative[relative].append((chromosome, start_point, end_point, length, snps))
+    return segments_by_relative
+
+def write_segments(filename, proband_name, relative_name, segments):
+    #one row per segment, laid out like a comparison copied from the 23andMe website
+    temp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(HEADER)
+        for chromosome, start_point, end_point, length, snps in segments:
+            writer.writerow([
+                proband_name + ' vs. ' + relative_name, chromosome, start_point, end_point, round(length, 2), snps,
+            ])
+    os.replace(temp_filename, filename)
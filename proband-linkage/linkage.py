@@ -0,0 +1,476 @@
+import csv
+import glob
+import io
+import os
+import sys
+from math import inf
+from os.path import basename
+from os.path import getsize
+from os.path import splitext
+from functools import partial
+from random import randint
+import numpy
+from time import perf_counter
+from zipfile import BadZipFile
+from jobs import map_jobs
+from rawdata import data_name_of
+from rawdata import open_raw_file
+from rawdata import strip_compression
+from profiling import Profiler
+from profiling import timed
+
+#SciPy takes longer to import than everything else put together, so it is only imported by the tests that need it
+
+CASE = 2
+CONTROL = 1
+UNKNOWN = 0
+
+CHROMOSOMES = list(map(str, range(1, 23))) + ['X']
+
+P_CACHE_VERSION = 1
+
+def expected_frequencies(tables):
+    #tables is an array of 2x2 contingency tables
+    tables = tables.astype(float)
+    row_sums = tables.sum(axis=2, keepdims=True)
+    column_sums = tables.sum(axis=1, keepdims=True)
+    totals = tables.sum(axis=(1, 2), keepdims=True)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return row_sums * column_sums / totals
+
+def chi_squared_sf(statistics):
+    #the survival function of the chi-squared distribution with one degree of freedom, as in scipy.stats.chi2.sf
+    from scipy.special import chdtrc
+    return chdtrc(1, statistics)
+
+def chi_squared_p(tables, yates):
+    '''
+    Return the p-values of Pearson's chi-squared test, with or without Yates's
+    continuity correction, of an array of 2x2 contingency tables. Tables with
+    an expected frequency of zero cannot be tested and get a p-value of NaN.
+    '''
+    observed = tables.astype(float)
+    expected = expected_frequencies(tables)
+    if yates:
+        diff = expected - observed
+        observed = observed + numpy.minimum(0.5, numpy.abs(diff)) * numpy.sign(diff)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        statistics = ((observed - expected) ** 2 / expected).reshape(-1, 4).sum(axis=1)
+    p = chi_squared_sf(statistics)
+    p[(expected == 0).any(axis=(1, 2))] = numpy.nan
+    return p
+
+def g_test_p(tables):
+    #p-values of the G-test of an array of 2x2 contingency tables
+    from scipy.special import xlogy
+    observed = tables.astype(float)
+    expected = expected_frequencies(tables)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        statistics = (2.0 * xlogy(observed, observed / expected)).reshape(-1, 4).sum(axis=1)
+    return chi_squared_sf(statistics)
+
+def log_factorial_table(n):
+    #log(k!) for every k up to n
+    from scipy.special import gammaln
+    return gammaln(numpy.arange(n + 1) + 1)
+
+def fisher_p(tables, log_factorials=None, tolerance=1e-7, chunk_size=1 << 22):
+    '''
+    Return the two-sided p-values of Fisher's exact test of an array of 2x2
+    contingency tables: the total probability of the tables with the same
+    margins that are no more likely than the observed table, allowing for a
+    relative rounding error of tolerance. log_factorials is a table of log(k!)
+    that is built here if it is missing or too short.
+    '''
+    a = tables[:, 0, 0].astype(numpy.int64)
+    n1 = tables[:, 0].sum(axis=1).astype(numpy.int64)
+    n2 = tables[:, 1].sum(axis=1).astype(numpy.int64)
+    n = tables[:, :, 0].sum(axis=1).astype(numpy.int64)
+    total = n1 + n2
+    p = numpy.ones(len(tables))
+    if len(tables) == 0:
+        return p
+    if log_factorials is None or len(log_factorials) <= total.max():
+        log_factorials = log_factorial_table(total.max())
+
+    def log_pmf(x):
+        #log probability of a table with x in the top left cell and the same margins
+        return (
+            log_factorials[n1_block] - log_factorials[x] - log_factorials[n1_block - x] +
+            log_factorials[n2_block] - log_factorials[n_block - x] - log_factorials[n2_block - n_block + x] -
+            log_factorials[total_block] + log_factorials[n_block] + log_factorials[total_block - n_block]
+        )
+
+    #tables with an empty row or column have a p-value of 1
+    testable = numpy.flatnonzero((n1 > 0) & (n2 > 0) & (n > 0) & (n < total))
+    width = int(n1.max()) + 1
+    block_size = max(chunk_size // width, 1)
+    for start in range(0, len(testable), block_size):
+        block = testable[start:start + block_size]
+        n1_block = n1[block, None]
+        n2_block = n2[block, None]
+        n_block = n[block, None]
+        total_block = total[block, None]
+        x = numpy.arange(width)[None, :]
+        support = (x >= n_block - n2_block) & (x <= numpy.minimum(n_block, n1_block))
+        x = numpy.where(support, x, numpy.maximum(n_block - n2_block, 0))
+        log_probabilities = log_pmf(x)
+        observed = log_pmf(a[block, None])
+        extreme = support & (log_probabilities <= observed + numpy.log1p(tolerance))
+        sums = numpy.where(extreme, numpy.exp(log_probabilities), 0).sum(axis=1)
+        #the most likely table has a p-value of exactly 1
+        mode = numpy.where(support, log_probabilities, -numpy.inf).max(axis=1)
+        p[block] = numpy.where(observed[:, 0] + numpy.log1p(tolerance) >= mode, 1.0, numpy.minimum(sums, 1.0))
+    return p
+
+def choose_tests(tables, method):
+    '''
+    Return an array of the test to use on each of an array of 2x2 contingency
+    tables: chi, fisher or g. The auto method uses the chi-squared test when at
+    least three expected frequencies are 5 or more and none is less than 1, and
+    Fisher's exact test otherwise.
+    '''
+    if method in ('chi', 'fisher', 'g'):
+        return numpy.full(len(tables), method)
+    expected = expected_frequencies(tables)
+    use_chi = ((expected >= 5).sum(axis=(1, 2)) >= 3) & ~(expected < 1).any(axis=(1, 2))
+    return numpy.where(use_chi, 'chi', 'fisher')
+
+class PValueCache:
+    '''
+    The p-values of the contingency tables tested so far, keyed by (test,
+    yates, a, b, c, d). The cells of the tables are bounded by the number of
+    cases and controls, so the same tables come up over and over again.
+    '''
+
+    def __init__(self, num_people):
+        self.p_values = {}
+        self.hits = 0
+        self.misses = 0
+        self.num_people = num_people
+        #log(k!) for every k up to the size of the cohort, built by the first Fisher test
+        self.log_factorials = None
+
+    def load(self, filename):
+        try:
+            with numpy.load(filename) as cached:
+                if int(cached['version']) != P_CACHE_VERSION:
+                    return
+                for test, yates, cells, p in zip(
+                    cached['tests'].tolist(), cached['yates'].tolist(), cached['tables'].tolist(), cached['p_values'].tolist()
+                ):
+                    self.p_values[(test, yates) + tuple(cells)] = p
+        except (OSError, ValueError, KeyError, BadZipFile):
+            pass
+
+    def save(self, filename):
+        keys = list(self.p_values)
+        temp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_filename, 'wb') as cache_file:
+            numpy.savez(
+                cache_file,
+                version=numpy.array(P_CACHE_VERSION),
+                tests=numpy.array([key[0] for key in keys], dtype='U6'),
+                yates=numpy.array([key[1] for key in keys], dtype=bool),
+                tables=numpy.array([key[2:] for key in keys], dtype=numpy.int64).reshape(-1, 4),
+                p_values=numpy.array([self.p_values[key] for key in keys], dtype=float),
+            )
+        os.replace(temp_filename, filename)
+
+    def test(self, tables, method, yates):
+        '''
+        Test an array of 2x2 contingency tables and return an array of p-values
+        and a list of the tests used. Only the tables that are not in the cache
+        are tested, and they are tested all at once.
+        '''
+        tests = choose_tests(tables, method).tolist()
+        keys = [
+            (test, yates and test == 'chi') + tuple(cells)
+            for test, cells in zip(tests, tables.reshape(-1, 4).tolist())
+        ]
+        missing = list(dict.fromkeys(key for key in keys if key not in self.p_values))
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        for test in ('chi', 'fisher', 'g'):
+            untested = [key for key in missing if key[0] == test]
+            if len(untested) == 0:
+                continue
+            untested_tables = numpy.array([key[2:] for key in untested], dtype=numpy.int64).reshape(-1, 2, 2)
+            if test == 'chi':
+                p_values = chi_squared_p(untested_tables, yates)
+            elif test == 'fisher':
+                if self.log_factorials is None:
+                    self.log_factorials = log_factorial_table(self.num_people)
+                p_values = fisher_p(untested_tables, self.log_factorials)
+            else:
+                p_values = g_test_p(untested_tables)
+            self.p_values.update(zip(untested, p_values.tolist()))
+
+        return numpy.array([self.p_values[key] for key in keys], dtype=float), tests
+
+def test_names(tests, yates):
+    if yates:
+        chi_name = 'Yates chi-squared'
+    else:
+        chi_name = 'Chi-squared'
+    names = {'chi': chi_name, 'fisher': 'Fisher', 'g': 'G-test'}
+    return [names[test] for test in tests]
+
+def membership_matrix(segments, num_people):
+    #one row per segment and one column per person, 1 if the person shares the segment
+    num_bytes = (num_people + 7) // 8
+    packed = numpy.frombuffer(
+        b''.join(segment[2].to_bytes(num_bytes, 'little') for segment in segments), dtype=numpy.uint8
+    ).reshape(len(segments), num_bytes)
+    return numpy.unpackbits(packed, axis=1, count=num_people, bitorder='little').astype(numpy.float32)
+
+def p_value_table(p_cache, num_cases, num_controls, method, yates):
+    '''
+    Return a table of the p-value of a segment shared by k people, a of whom
+    are cases, indexed by [k, a]. Relabeling the cases and controls does not
+    change how many people share each segment, so this table covers every
+    permutation. Impossible and untestable tables get a p-value of infinity.
+    '''
+    carriers, case_carriers = numpy.meshgrid(
+        numpy.arange(num_cases + num_controls + 1), numpy.arange(num_cases + 1), indexing='ij'
+    )
+    possible = (case_carriers <= carriers) & (carriers - case_carriers <= num_controls)
+    a = case_carriers[possible]
+    b = carriers[possible] - a
+    tables = numpy.stack([a, b, num_cases - a, num_controls - b], axis=1).reshape(-1, 2, 2)
+    p_table = numpy.full(carriers.shape, inf)
+    p_table[possible] = p_cache.test(tables, method, yates)[0]
+    p_table[numpy.isnan(p_table)] = inf
+    return p_table
+
+#(membership, carriers, is_case, relatives, p_table) of the permutations being run, inherited by forked workers
+permutation_state = None
+
+def permutation_block(block):
+    '''
+    Shuffle the case and control labels of the relatives once per permutation
+    in a block, with the block's own random number generator, and return the
+    smallest p-value of any segment in each permutation.
+    '''
+    membership, carriers, is_case, relatives, p_table = permutation_state
+    block_seed, size = block
+    rng = numpy.random.default_rng(block_seed)
+    labels = numpy.tile(is_case, (size, 1))
+    for row in labels:
+        row[relatives] = rng.permutation(is_case[relatives])
+    case_carriers = numpy.rint(membership @ labels.T).astype(numpy.intp)
+    return p_table[carriers[:, None], case_carriers].min(axis=0, initial=inf)
+
+def run_permutations(state, num_permutations, seed, jobs=1, block_size=100):
+    #the blocks get their seeds in order, so the results do not depend on the number of jobs
+    global permutation_state
+    permutation_state = state
+    sizes = [min(block_size, num_permutations - start) for start in range(0, num_permutations, block_size)]
+    blocks = list(zip(numpy.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+    results = list(map_jobs(permutation_block, blocks, jobs))
+    permutation_state = None
+    return numpy.concatenate(results + [numpy.empty(0)])
+
+def adjust_p_values(min_p_values, p_values):
+    #the fraction of permutations whose smallest p-value is at most the segment's p-value
+    min_p_values = numpy.sort(min_p_values)
+    adjusted = (1 + numpy.searchsorted(min_p_values, p_values, side='right')) / (len(min_p_values) + 1)
+    adjusted[numpy.isnan(p_values)] = numpy.nan
+    return adjusted
+
+def add_breakpoints(starts, start_point, end_point):
+    '''
+    Split the segments of one chromosome at the start and end points of a shared
+    segment and return the first and last+1 positions of the segments that it
+    covers. starts is the set of positions where segments start. A segment is
+    only split at a point strictly inside it, so whether a point becomes a new
+    boundary depends on the points that were added before it.
+    '''
+    if start_point not in starts and start_point + 1 not in starts:
+        starts.add(start_point)
+    if end_point not in starts and end_point + 1 not in starts:
+        starts.add(end_point + 1)
+    first = start_point if start_point in starts else start_point + 1
+    after = end_point + 1 if end_point + 1 in starts else end_point
+    return first, after
+
+def build_segments(starts, coverage, everyone, num_people):
+    '''
+    Sort the segment boundaries of one chromosome and sweep across them once,
+    returning a list of [start, end, members] segments, where members is a
+    bitset of the people who share the segment. coverage is a list of (person,
+    first, after) ranges from add_breakpoints and everyone is a bitset of the
+    people who share every segment.
+    '''
+    starts = sorted(starts)
+    index = {start: i for i, start in enumerate(starts)}
+    events = [[] for start in starts]
+    for person, first, after in coverage:
+        if first < after:
+            events[index[first]].append((person, 1))
+            events[index[after]].append((person, -1))
+
+    segments = []
+    active = [0] * num_people #number of each person's shared segments that cover this one
+    members = everyone
+    for i in range(0, len(starts) - 1):
+        for person, change in events[i]:
+            active[person] += change
+            if active[person] == 0:
+                members &= ~(1 << person)
+            else:
+                members |= 1 << person
+        segments.append([starts[i], starts[i + 1] - 1, members])
+    return segments
+
+def count_people(bits):
+    return bin(bits).count('1')
+
+def pad_key(pair):
+    try:
+        return (str(int(pair[0])).zfill(2), pair[1])
+    except ValueError:
+        return pair
+
+def list_files(csv_dir, recursive=False):
+    #sorted, so that the results do not depend on the order of the directory entries
+    return sorted(
+        filename for filename in glob.glob(csv_dir + '/**', recursive=recursive) if data_name_of(filename).endswith('.csv')
+    )
+
+def read_segments(filename):
+    #the (chromosome, start point, end point) of each segment in a comparison file, which may be compressed
+    segments = []
+    raw_file, data_name = open_raw_file(filename)
+    with io.TextIOWrapper(raw_file) as csv_file:
+        for row in csv.reader(csv_file):
+            if row == ['Comparison', 'Chromosome', 'Start Point', 'End Point', 'Genetic Distance', '#SNPs']:
+                continue
+            segments.append((row[1], int(row[2]), int(row[3])))
+    return segments
+
+class Cohort:
+    '''
+    The proband's relatives and the segments that they share with the proband.
+    People are numbered in the order that they are loaded, and groups of people
+    are bitsets of those numbers. If the proband is a case or a control, the
+    proband is person 0 and shares every segment.
+    '''
+
+    def __init__(self, proband_affection, profiler=None):
+        self.people = []
+        self.cases = 0
+        self.controls = 0
+        self.profiler = profiler or Profiler()
+
+        if proband_affection in (CASE, CONTROL):
+            self.people.append('Proband')
+            if proband_affection == CASE:
+                self.cases = 1
+            else:
+                self.controls = 1
+        self.proband = self.cases | self.controls
+
+        #the positions where segments start on each chromosome, and the ranges of segments shared with each person
+        self.breakpoints = {chromosome: {0, sys.maxsize + 1} for chromosome in CHROMOSOMES}
+        self.coverage = {chromosome: [] for chromosome in CHROMOSOMES}
+
+    @property
+    def num_cases(self):
+        return count_people(self.cases)
+
+    @property
+    def num_controls(self):
+        return count_people(self.controls)
+
+    def load_files(self, files, jobs=1, randomize=False):
+        '''
+        Read the comparison files in files, a list of (filename, is_case) pairs,
+        and add each person's segments to the breakpoints and coverage of their
+        chromosomes in the order of files. If randomize is true, each person is
+        put in the case or control group at random.
+        '''
+        filenames = [filename for filename, is_case in files]
+        read_files = map_jobs(partial(timed, read_segments), filenames, jobs)
+        for (filename, is_case), (segments, read_time) in zip(files, read_files):
+            start = perf_counter()
+            if randomize:
+                is_case = randint(0, 1)
+            person_name = splitext(basename(strip_compression(filename)))[0]
+            person = len(self.people)
+            self.people.append(person_name)
+            for chromosome, start_point, end_point in segments:
+                #a row that ends before it starts covers nothing, so it splits nothing
+                if end_point < start_point:
+                    continue
+                first, after = add_breakpoints(self.breakpoints[chromosome], start_point, end_point)
+                self.coverage[chromosome].append((person, first, after))
+            if is_case:
+                self.cases |= 1 << person
+            else:
+                self.controls |= 1 << person
+            self.profiler.add_file(filename, getsize(filename), len(segments), read_time + perf_counter() - start)
+
+    def partition(self):
+        #the segments of each chromosome, split wherever anyone's shared segments start or end
+        return {
+            chromosome: build_segments(self.breakpoints[chromosome], self.coverage[chromosome], self.proband, len(self.people))
+            for chromosome in CHROMOSOMES
+        }
+
+    def tested_segments(self, linkage):
+        '''
+        Return a (chromosome, segment, cases with the segment, controls with the
+        segment) tuple for each segment of linkage from partition, sorted by
+        chromosome, leaving out the unbounded segments at either end of each
+        chromosome.
+        '''
+        tested = []
+        for chromosome, segments in sorted(linkage.items(), key=pad_key):
+            for segment in segments:
+                if segment[0] == 0 or segment[1] == sys.maxsize:
+                    continue
+                cases_with_segment = count_people(segment[2] & self.cases)
+                controls_with_segment = count_people(segment[2] & self.controls)
+                tested.append((chromosome, segment, cases_with_segment, controls_with_segment))
+        return tested
+
+    def test_segments(self, tested, method='auto', yates=True, p_cache=None):
+        '''
+        Test the segments in tested, from tested_segments, with one 2x2
+        contingency table per segment: cases and controls with the segment, then
+        cases and controls without it. Return the tables, their p-values and
+        the tests used.
+        '''
+        num_cases = self.num_cases
+        num_controls = self.num_controls
+        tables = numpy.array([
+            [[cases_with_segment, controls_with_segment], [num_cases - cases_with_segment, num_controls - controls_with_segment]]
+            for chromosome, segment, cases_with_segment, controls_with_segment in tested
+        ], dtype=numpy.int64).reshape(-1, 2, 2)
+        if p_cache is None:
+            p_cache = PValueCache(len(self.people))
+        p_values, tests = p_cache.test(tables, method, yates)
+        return tables, p_values, tests
+
+    def permutation_test(self, tested, p_cache, num_permutations, seed, method='auto', yates=True, jobs=1):
+        '''
+        Relabel everyone but the proband num_permutations times, keeping the
+        number of cases and controls, and return the smallest p-value of any
+        segment in tested in each permutation.
+        '''
+        membership = membership_matrix([segment for chromosome, segment, cases_with_segment, controls_with_segment in tested], len(self.people))
+        carriers = numpy.rint(membership.sum(axis=1)).astype(numpy.intp)
+        is_case = numpy.array([(self.cases >> person) & 1 for person in range(0, len(self.people))], dtype=numpy.float32)
+        relatives = numpy.arange(1 if self.proband else 0, len(self.people))
+        p_table = p_value_table(p_cache, self.num_cases, self.num_controls, method, yates)
+        return run_permutations((membership, carriers, is_case, relatives, p_table), num_permutations, seed, jobs)
+
+    def names_of(self, bits):
+        names = set()
+        while bits:
+            person = (bits & -bits).bit_length() - 1
+            names.add(self.people[person])
+            bits &= bits - 1
+        return names
@@ -22,24 +22,30 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import csv
-import glob
 import sys
-from copy import copy
 from getopt import getopt
-from math import sqrt
-from os.path import basename
-from os.path import splitext
+from os.path import dirname
+from os.path import getsize
+from os.path import join
+from os.path import realpath
 from random import randint
-from scipy.stats import chi2_contingency
-from scipy.stats import fisher_exact
-from scipy.stats import power_divergence
-from scipy.stats.contingency import expected_freq
+import numpy
 from sys import stderr
 
-CASE = 2
-CONTROL = 1
-UNKNOWN = 0
+#the modules shared with convert.py are in the convert directory
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'convert'))
+
+from linkage import CASE
+from linkage import CONTROL
+from linkage import UNKNOWN
+from linkage import Cohort
+from linkage import PValueCache
+from linkage import adjust_p_values
+from linkage import list_files
+from linkage import test_names
+from profiling import Profiler
+
+PHASES = ('load', 'partition', 'tests', 'permutations', 'output')
 
 case_dir = 'cases'
 control_dir = 'controls'
@@ -51,10 +57,16 @@ method = 'auto'
 yates = True
 want_misfits = False
 randomize = False
+p_cache_filename = None
+permutations = 0
+jobs = 1
+seed = None
+profile_filename = None
+profile_phase = None
 
 optlist, args = getopt(
     sys.argv[1:],
-    '-ar',
+    '-arj:',
     [
         'cases=',
         'controls=',
@@ -66,6 +78,12 @@ optlist, args = getopt(
         'no-yates',
         'misfits',
         'randomize',
+        'p-cache=',
+        'permutations=',
+        'jobs=',
+        'seed=',
+        'profile=',
+        'profile-phase=',
         'help',
     ]
 )
@@ -95,16 +113,38 @@ for name, value in optlist:
         want_misfits = True
     elif name == '--randomize':
         randomize = True
+    elif name == '--p-cache':
+        p_cache_filename = value
+    elif name == '--permutations':
+        permutations = int(value)
+    elif name in ('-j', '--jobs'):
+        jobs = int(value)
+    elif name == '--seed':
+        seed = int(value)
+    elif name == '--profile':
+        profile_filename = value
+    elif name == '--profile-phase':
+        if value not in PHASES:
+            stderr.write('Unknown phase: ' + value + '\n')
+            exit(1)
+        profile_phase = value
     elif name == '--help':
         print('Syntax: ./proband-linkage.py [--cases=<dir>] [--controls=<dir>]')
         print('                [-r | --recursive] [--proband=(case|control|unknown)]')
         print('                [-a <value> | --alpha=<value>] [--no-bonferroni]')
         print('                [--method=(chi|fisher|g|auto)] [--no-yates] [--misfits]')
-        print('                [--randomize]')
+        print('                [--randomize] [--p-cache=<file>] [--permutations=<n>]')
+        print('                [-j <n> | --jobs=<n>] [--seed=<n>] [--profile=<file>]')
+        print('                [--profile-phase=(load|partition|tests|permutations|output)]')
         print('cases defaults to ./cases, controls defaults to ./controls, alpha defaults to')
-        print('0.05, and method defaults to auto.')
+        print('0.05, method defaults to auto, permutations defaults to 0, and jobs defaults')
+        print('to 1.')
         exit()
 
+if profile_phase and not profile_filename:
+    stderr.write('--profile-phase requires --profile\n')
+    exit(1)
+
 while proband_affection == None:
     if randomize:
         proband_affection = randint(CONTROL, CASE)
@@ -120,170 +160,101 @@ while proband_affection == None:
     else:
         proband_affection = None
 
-def create_start_point(segments, point):
-    for i in range(0, len(segments)):
-        if segments[i][0] < point and point < segments[i][1]:
-            #shrink the segment and insert a new segment after it with the same people
-            segments.insert(i + 1, [point, segments[i][1], copy(segments[i][2]), copy(segments[i][3])])
-            segments[i][1] = point - 1
-            break
+profiler = Profiler(profile_phase)
+cohort = Cohort(proband_affection, profiler)
 
-def create_end_point(segments, point):
-    for i in range(0, len(segments)):
-        if segments[i][0] < point and point < segments[i][1]:
-            #shrink the segment and insert a new segment before it with the same people
-            segments.insert(i, [segments[i][0], point, copy(segments[i][2]), copy(segments[i][3])])
-            segments[i + 1][0] = point + 1
-            break
+with profiler.phase('load') as counts:
+    files = (
+        [(filename, True) for filename in list_files(case_dir, recursive)] +
+        [(filename, False) for filename in list_files(control_dir, recursive)]
+    )
+    cohort.load_files(files, jobs, randomize)
+    counts['files'] += len(files)
+    counts['bytes'] += sum(getsize(filename) for filename, is_case in files)
+    counts['rows'] += sum(len(ranges) for ranges in cohort.coverage.values())
 
-if proband_affection == CASE:
-    cases = ['Proband']
-    controls = []
-elif proband_affection == CONTROL:
-    cases = []
-    controls = ['Proband']
-else:
-    cases = []
-    controls = []
+with profiler.phase('partition') as counts:
+    linkage = cohort.partition()
 
-linkage = {
-     '1': [[0, sys.maxsize, copy(cases), copy(controls)]],
-     '2': [[0, sys.maxsize, copy(cases), copy(controls)]],
-     '3': [[0, sys.maxsize, copy(cases), copy(controls)]],
-     '4': [[0, sys.maxsize, copy(cases), copy(controls)]],
-     '5': [[0, sys.maxsize, copy(cases), copy(controls)]],
-     '6': [[0, sys.maxsize, copy(cases), copy(controls)]],
-     '7': [[0, sys.maxsize, copy(cases), copy(controls)]],
-     '8': [[0, sys.maxsize, copy(cases), copy(controls)]],
-     '9': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '10': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '11': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '12': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '13': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '14': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '15': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '16': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '17': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '18': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '19': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '20': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '21': [[0, sys.maxsize, copy(cases), copy(controls)]],
-    '22': [[0, sys.maxsize, copy(cases), copy(controls)]],
-     'X': [[0, sys.maxsize, copy(cases), copy(controls)]],
-}
+    total_segments = 0
+    for chromosome, segments in linkage.items():
+        total_segments += len(segments)
+    counts['people'] += len(cohort.people)
+    counts['breakpoints'] += sum(len(starts) for starts in cohort.breakpoints.values())
+    counts['segments'] += total_segments
 
-def load_files(csv_dir, is_case):
-    global cases
-    global controls
-    for filename in glob.glob(csv_dir + '/**', recursive=recursive):
-        if not filename.endswith('.csv'):
-            continue
-        if randomize:
-            is_case = randint(0, 1)
-        person_name = splitext(basename(filename))[0]
-        for row in csv.reader(open(filename, 'r')):
-            if row == ['Comparison', 'Chromosome', 'Start Point', 'End Point', 'Genetic Distance', '#SNPs']:
-                continue
-            chromosome = row[1]
-            start_point = int(row[2])
-            end_point = int(row[3])
-            create_start_point(linkage[chromosome], start_point)
-            create_end_point(linkage[chromosome], end_point)
-            for segment in linkage[chromosome]:
-                if start_point <= segment[0] and segment[1] <= end_point:
-                    if is_case:
-                        segment[2].append(person_name)
-                    else:
-                        segment[3].append(person_name)
-        if is_case:
-            cases.append(person_name)
-        else:
-            controls.append(person_name)
+num_cases = cohort.num_cases
+num_controls = cohort.num_controls
+cases = cohort.cases
+controls = cohort.controls
 
-load_files(case_dir, True)
-load_files(control_dir, False)
+stderr.write('Comparing ' + str(total_segments) + ' segments between ' + str(num_cases) + ' cases and ' + str(num_controls) + ' controls.\n')
 
-total_segments = 0
-for chromosome, segments in linkage.items():
-    total_segments += len(segments)
+difference_found = False
 
-stderr.write('Comparing ' + str(total_segments) + ' segments between ' + str(len(cases)) + ' cases and ' + str(len(controls)) + ' controls.\n')
+with profiler.phase('tests') as counts:
+    tested = cohort.tested_segments(linkage)
+    p_cache = PValueCache(len(cohort.people))
+    if p_cache_filename:
+        p_cache.load(p_cache_filename)
+    tables, p_values, tests = cohort.test_segments(tested, method, yates, p_cache)
+    method_names = test_names(tests, yates)
+    counts['tables'] += len(tables)
+    for test in tests:
+        counts[test + '_tests'] += 1
+    counts['cache_hits'] += p_cache.hits
+    counts['cache_misses'] += p_cache.misses
 
-difference_found = False
+if permutations > 0:
+    with profiler.phase('permutations') as counts:
+        if seed is None:
+            seed = numpy.random.SeedSequence().entropy
+            stderr.write('Permutation seed: ' + str(seed) + '\n')
+        min_p_values = cohort.permutation_test(tested, p_cache, permutations, seed, method, yates, jobs)
+        family_wise_error_rate = numpy.count_nonzero(min_p_values <= alpha / m) / permutations
+        stderr.write(
+            'Empirical family-wise error rate at p <= ' + str(alpha / m) + ': ' + str(family_wise_error_rate) +
+            ' in ' + str(permutations) + ' permutations.\n'
+        )
+        adjusted_p_values = adjust_p_values(min_p_values, p_values)
+        counts['permutations'] += permutations
+        counts['segments'] += len(tested)
+        counts['tables'] += (num_cases + num_controls + 1) * (num_cases + 1)
+else:
+    adjusted_p_values = numpy.full(len(tested), numpy.nan)
 
-def pad_key(pair):
+stderr.write('P-value cache: ' + str(p_cache.hits) + ' hits, ' + str(p_cache.misses) + ' misses.\n')
+if p_cache_filename:
     try:
-        return (str(int(pair[0])).zfill(2), pair[1])
-    except ValueError:
-        return pair
+        p_cache.save(p_cache_filename)
+    except OSError as error:
+        stderr.write('Could not save the p-value cache: ' + str(error) + '\n')
 
-for chromosome, segments in sorted(linkage.items(), key=pad_key):
-    for segment in segments:
-        if segment[0] == 0 or segment[1] == sys.maxsize:
-            continue
+with profiler.phase('output') as counts:
+    for (chromosome, segment, cases_with_segment, controls_with_segment), p, method_name, adjusted_p in zip(
+        tested, p_values.tolist(), method_names, adjusted_p_values.tolist()
+    ):
         try:
-            contingency_table = [
-                #Cases with segment            Controls with segment
-                [len(segment[2]),              len(segment[3])],
-                #Cases without segment         Controls without segment
-                [len(cases) - len(segment[2]), len(controls) - len(segment[3])]
-            ]
-            if method == 'chi':
-                p = chi2_contingency(contingency_table, correction=yates)[1]
-                if yates:
-                    method_name = 'Yates chi-squared'
-                else:
-                    method_name = 'Chi-squared'
-            elif method == 'fisher':
-                p = fisher_exact(contingency_table)[1]
-                method_name = 'Fisher'
-            elif method == 'g':
-                p = power_divergence(
-                    contingency_table[0] + contingency_table[1],
-                    f_exp=expected_freq(contingency_table).ravel(),
-                    ddof=2,
-                    lambda_='log-likelihood'
-                )[1]
-                method_name = 'G-test'
-            else:
-                expected_frequency_table = expected_freq(contingency_table)
-                num_large_cells = 0
-                num_small_cells = 0
-                for row in expected_frequency_table:
-                    for cell in row:
-                        if cell >= 5:
-                            num_large_cells += 1
-                        elif cell < 1:
-                            num_small_cells += 1
-                            break
-                if num_large_cells >= 3 and num_small_cells == 0:
-                    p = chi2_contingency(contingency_table, correction=yates)[1]
-                    if yates:
-                        method_name = 'Yates chi-squared'
-                    else:
-                        method_name = 'Chi-squared'
-                else:
-                    p = fisher_exact(contingency_table)[1]
-                    method_name = 'Fisher'
-
             if p <= alpha / m:
                 if not difference_found:
                     header = 'Chromosome\tStart\tEnd\tCase freq\tControl freq\tp\tMethod'
+                    if permutations > 0:
+                        header += '\tAdjusted p'
                     if want_misfits:
                         header += '\tCase misfits\tControl misfits'
                     print(header)
                     difference_found = True
 
-                case_freq = len(segment[2]) / len(cases)
-                control_freq = len(segment[3]) / len(controls)
+                case_freq = cases_with_segment / num_cases
+                control_freq = controls_with_segment / num_controls
                 if case_freq >= control_freq:
                     #we expect the cases to have the allele and the controls to not have it
-                    case_misfits = set(cases).difference(set(segment[2]))
-                    control_misfits = set(segment[3])
+                    case_misfits = cases & ~segment[2]
+                    control_misfits = controls & segment[2]
                 else:
                     #we expect the cases to not have the allele and the controls to have it
-                    case_misfits = set(segment[2])
-                    control_misfits = set(controls).difference(set(segment[3]))
+                    case_misfits = cases & segment[2]
+                    control_misfits = controls & ~segment[2]
 
                 output = (
                     str(chromosome) + '\t' +
@@ -294,14 +265,20 @@ for chromosome, segments in sorted(linkage.items(), key=pad_key):
                     str(p) + '\t' +
                     method_name
                 )
+                if permutations > 0:
+                    output += '\t' + str(adjusted_p)
                 if want_misfits:
                     output += (
-                        '\t' + str(case_misfits) +
-                        '\t' + str(control_misfits)
+                        '\t' + str(cohort.names_of(case_misfits)) +
+                        '\t' + str(cohort.names_of(control_misfits))
                     )
                 print(output)
+                counts['rows'] += 1
         except ZeroDivisionError:
             pass
 
 if not difference_found:
     stderr.write('There is no significant difference between the cases and the controls.\n')
+
+if profile_filename:
+    profiler.write(profile_filename, 'proband-linkage.py')